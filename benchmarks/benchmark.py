@@ -0,0 +1,250 @@
+"""
+Benchmarks of the estimation hot paths on synthetic incidence. Every stage is timed on a grid of series lengths and
+numbers of regions, its peak memory is traced in a separate run, and the results are written as json. Given a
+baseline json, the stages that became slower or larger are listed and the script exits with status 1.
+
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --output results.json --baseline baseline.json
+
+benchmarks/baseline.json was written by the command the Benchmarks workflow compares against it on every push, a
+grid small enough for the runner. Two runs of the same code on one machine differ by up to 1.8x in time, the peaks of
+memory are the same, hence the tolerance:
+
+    python benchmarks/benchmark.py --days 100 1000 10000 --regions 1 100 --max-cells 1000000 --tolerance 3 --baseline benchmarks/baseline.json
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import platform
+import datetime
+import tempfile
+import tracemalloc
+import warnings
+import numpy as np
+import scipy
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pakistan_data"))
+sys.path.insert(0, os.path.join(ROOT, "cori_2013"))
+import analysis
+import csv_to_txt
+import nowcasting
+import reproduction_number_estimation as cori
+
+DAYS = (100, 1000, 10000, 100000)
+REGIONS = (1, 100, 10000)
+MAX_CELLS = 2 * 10**7 #days x regions above this are skipped
+MEAN_SI = 4
+SD_SI = 5
+WINDOW = 4
+SEED = 0
+
+
+def synthetic_incidence(days, regions, seed = SEED, kernel_days = 60, capacity = 1000):
+    """
+    :param days: the length of every series.
+    :param regions: the number of series.
+    :param seed: seed of the random number generator.
+    :param kernel_days: the last day of the infectious profile of the renewal process.
+    :param capacity: the force of infection at which transmission saturates.
+    :return: an int64 array of shape (regions, days) of incident cases.
+
+    A renewal process with R_t oscillating around 1 and a saturating force of infection, plus one imported case a
+    day, so series of any length neither die out nor explode. Every region has its own phase of R_t.
+    """
+    rng = np.random.default_rng(seed)
+    w = analysis.infection_profile_kernel(MEAN_SI, SD_SI, kernel_days)
+    phase = rng.uniform(0, 2 * np.pi, regions)
+    incidence = np.zeros((regions, days))
+    incidence[:, 0] = 10
+    for t in range(1, days):
+        K = min(t, kernel_days)
+        force = incidence[:, t - K:t] @ w[K:0:-1]
+        r_t = np.exp(0.4 * np.sin(2 * np.pi * t / 180 + phase))
+        incidence[:, t] = rng.poisson(r_t * force / (1 + force / capacity) + 1)
+    return incidence.astype(np.int64)
+
+
+def write_series(file_name, incidence_data):
+    csv_to_txt.write_txt(file_name[:-len(".txt")], "01-Jan-20", "01-Jan-20", incidence_data)
+
+
+def write_cumulative_csv(file_name, incidence):
+    cumulative = np.cumsum(incidence, axis = 1).T
+    first = datetime.date(2020, 1, 1)
+    with open(file_name, newline='', mode='w') as csvfile:
+        spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|')
+        spamwriter.writerow(["Date"] + [f"R{i}" for i in range(len(incidence))])
+        for day in range(len(cumulative)):
+            date = (first + datetime.timedelta(days = day)).strftime(csv_to_txt.DATE_FORMAT)
+            spamwriter.writerow([date] + list(cumulative[day]))
+
+
+def model_epidemic_r_t(data_file, uncertain_w):
+    analysis.model_epidemic(data_file, MEAN_SI, SD_SI, window = WINDOW, plot_r_t = True, uncertain_w = uncertain_w,
+                            plot_surface = plt.gca())
+    plt.close("all")
+
+
+def oscillating_R_t(t):
+    return 1 + 0.3 * np.sin(2 * np.pi * t / 180) #epidemics die out slowly instead of overflowing the poisson draws
+
+
+def lambda_t_loop(incidence_data, w):
+    return [analysis.lambda_t(t, incidence_data, w) for t in range(len(incidence_data) + 1)]
+
+
+def estimate_R_t_loop(incidence_data, w):
+    return [analysis.estimate_R_t(t, WINDOW, incidence_data, w) for t in range(WINDOW, len(incidence_data) + 1)]
+
+
+def stages(incidence, directory):
+    """
+    :param incidence: an array of shape (regions, days) of incident cases.
+    :param directory: a directory the file based stages may write to.
+    :return: a list of (name, function, max_days, max_regions, setup). A stage is skipped when the input is longer than
+    max_days or has more regions than max_regions, setup is called before it is measured. The stages of a single
+    series run on the first region only, on a grid point with one region.
+    """
+    T = incidence.shape[-1]
+    series = list(incidence[0])
+    w = analysis.infection_profile(MEAN_SI, SD_SI)
+    kernel = analysis.infection_profile_kernel(MEAN_SI, SD_SI, T)
+    truncated_kernel, discarded = analysis.truncated_infection_profile_kernel(MEAN_SI, SD_SI)
+    positive_kernel = np.maximum(kernel, 0) #the far tail holds round off below zero, which poisson draws reject
+    delay = nowcasting.delay_distribution()
+    data_file = os.path.join(directory, "series.txt")
+    csv_file = os.path.join(directory, "cumulative.csv")
+
+    def setup_model_epidemic():
+        write_series(data_file, incidence[0])
+
+    def run_csv_to_txt():
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            csv_to_txt.csv_to_txt(csv_file, store_name = os.path.join(directory, "incidence"))
+        finally:
+            os.chdir(cwd)
+
+    return [
+        ("infection_profile", lambda: analysis.kernel_array(analysis.infection_profile(MEAN_SI, SD_SI), T), None, 1, None),
+        ("infection_profile_kernel", lambda: analysis.infection_profile_kernel(MEAN_SI, SD_SI, T), None, 1, None),
+        ("lambda_t", lambda: lambda_t_loop(series, w), 1000, 1, None),
+        ("lambda_series", lambda: analysis.lambda_series(incidence, kernel), None, None, None),
+        ("lambda_series_truncated", lambda: analysis.lambda_series(incidence, truncated_kernel), None, None, None),
+        ("estimate_R_t", lambda: estimate_R_t_loop(series, w), 100, 1, None),
+        ("estimate_R_t_series", lambda: analysis.estimate_R_t_series(incidence, kernel, WINDOW), None, None, None),
+        ("model_epidemic", lambda: model_epidemic_r_t(data_file, False), None, 1, setup_model_epidemic),
+        ("model_epidemic_uncertain_w", lambda: model_epidemic_r_t(data_file, True), 10000, 1, setup_model_epidemic),
+        ("simulate_epidemics", lambda: cori.simulate_epidemics(oscillating_R_t, positive_kernel, T, len(incidence), rng = np.random.default_rng(SEED)), 10000, None, None),
+        ("csv_to_txt", run_csv_to_txt, 10000, None, lambda: write_cumulative_csv(csv_file, incidence)), #two digit years wrap after 2068
+        ("nowcast", lambda: nowcasting.nowcast(incidence, delay, n_bootstrap = 20, rng = np.random.default_rng(SEED)), 10000, 100, None),
+    ]
+
+
+def measure(function, repeat):
+    """
+    :return: the fastest of repeat timed calls in seconds, and the peak of the memory traced during one more call.
+    """
+    seconds = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(seconds), peak
+
+
+def run_benchmarks(days = DAYS, regions = REGIONS, max_cells = MAX_CELLS, repeat = 3, only = None):
+    """
+    :param days, regions: the grid of series lengths and numbers of regions.
+    :param max_cells: grid points with more than max_cells days x regions are skipped.
+    :param repeat: the number of timed calls of every stage.
+    :param only: optional names of the stages to run.
+    :return: a list of dicts with the stage, days, regions, seconds and peak_bytes.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory, warnings.catch_warnings():
+        warnings.simplefilter("ignore") #plt.show on Agg and the scalar paths warn
+        for T in days:
+            for n in regions:
+                if T * n > max_cells:
+                    continue
+                incidence = synthetic_incidence(T, n)
+                for name, function, max_days, max_regions, setup in stages(incidence, directory):
+                    if (only and name not in only) or (max_days and T > max_days) or (max_regions and n > max_regions):
+                        continue
+                    if setup:
+                        setup()
+                    seconds, peak = measure(function, repeat)
+                    results.append({"stage": name, "days": T, "regions": n, "seconds": seconds, "peak_bytes": peak})
+                    print(f"{name:28s} days = {T:6d} regions = {n:5d} {seconds:10.4f} s {peak / 2**20:10.1f} MiB", flush = True)
+
+        if not only or "simulate_i_t_and_r_t" in only:
+            seconds, peak = measure(lambda: cori.simulate_i_t_and_r_t(rng = np.random.default_rng(SEED)), repeat)
+            plt.close("all")
+            results.append({"stage": "simulate_i_t_and_r_t", "days": 50, "regions": 100, "seconds": seconds, "peak_bytes": peak})
+            print(f"{'simulate_i_t_and_r_t':28s} days = {50:6d} regions = {100:5d} {seconds:10.4f} s {peak / 2**20:10.1f} MiB")
+    return results
+
+
+def compare(results, baseline, tolerance = 1.5, min_seconds = 1e-3):
+    """
+    :param results: the output of run_benchmarks.
+    :param baseline: the results of an earlier run.
+    :param tolerance: the ratio to the baseline above which a time or a peak of memory is a regression.
+    :param min_seconds: times below this are timer noise and never a regression.
+    :return: a list of (stage, days, regions, quantity, ratio) of the regressions.
+    """
+    previous = {(i["stage"], i["days"], i["regions"]): i for i in baseline}
+    regressions = []
+    for result in results:
+        key = (result["stage"], result["days"], result["regions"])
+        if key not in previous:
+            continue
+        for quantity in ("seconds", "peak_bytes"):
+            ratio = result[quantity] / max(previous[key][quantity], 1e-9)
+            if ratio > tolerance and not (quantity == "seconds" and result[quantity] < min_seconds):
+                regressions.append(key + (quantity, ratio))
+    return regressions
+
+
+def environment():
+    return {"date": datetime.datetime.now().isoformat(timespec = "seconds"), "python": platform.python_version(),
+            "numpy": np.__version__, "scipy": scipy.__version__, "machine": platform.machine(),
+            "processor": platform.processor(), "cpus": os.cpu_count()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the estimation hot paths on synthetic incidence.")
+    parser.add_argument("--days", type = int, nargs = "+", default = DAYS)
+    parser.add_argument("--regions", type = int, nargs = "+", default = REGIONS)
+    parser.add_argument("--max-cells", type = int, default = MAX_CELLS)
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--stages", nargs = "+", help = "only run these stages")
+    parser.add_argument("--output", default = "benchmark_results.json")
+    parser.add_argument("--baseline", help = "results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type = float, default = 1.5)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.days, args.regions, args.max_cells, args.repeat, args.stages)
+    with open(args.output, "w") as output_file:
+        json.dump({"environment": environment(), "results": results}, output_file, indent = 1)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file)["results"], args.tolerance)
+        for stage, T, n, quantity, ratio in regressions:
+            print(f"REGRESSION {stage} days = {T} regions = {n}: {quantity} x {ratio:.2f}")
+        sys.exit(1 if regressions else 0)
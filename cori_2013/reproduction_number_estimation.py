@@ -1,8 +1,10 @@
 import numpy as np
-from scipy import stats
+from scipy import stats, signal
 import matplotlib.pyplot as plt
 import math
 
+DIRECT_CONVOLUTION_DAYS = 500 #series longer than this are convolved with FFT
+
 
 
 
@@ -18,12 +20,13 @@ def prior_instant_R_t(t):
         return 2.5
     return 0.7
 
-def estimate_I_t(t, instant_R_t, incidence_data, w):
+def estimate_I_t(t, instant_R_t, incidence_data, w, lambdas = None):
     '''
     :param t: t (in days) at which to estimate I_t
     :param instant_R_t: a function of the form f(t) which returns the reproduction number at a given time t.
     :param incidence_data: a list of integers. indcidence_data[s] represents the number of incident cases on day s.
     :param w: a probability density function describing the infectious profile with signature f(t) where is an integer. w(s) represents the probability of spreading the infection on day s.
+    :param lambdas: optional output of lambda_series(incidence_data, w), used instead of recomputing lambda_t.
     :return: prediction of the number of incidence cases on day t.
 
     Follwing appendix 1 of cori 2013. I_t follows a poisson distribution. (See eq. 1 of equations page)
@@ -33,7 +36,10 @@ def estimate_I_t(t, instant_R_t, incidence_data, w):
     #for s in range(t):
     #    summation += (incidence_data[s] * w(s))
 
-    summation = lambda_t(t, incidence_data, w)
+    if lambdas is None:
+        summation = lambda_t(t, incidence_data, w)
+    else:
+        summation = lambdas[t]
 
 
     mean = prior_instant_R_t(t) * summation #mean of poisson distribution
@@ -55,16 +61,62 @@ def lambda_t(t, incidence_data, w):
 
     return summation
 
+def kernel_array(w, K):
+    """
+    :param w: infectious profile, either an ndarray from infection_profile_kernel (kernel[..., s] is the probability
+    at day s) or a function with signature w(t).
+    :param K: the last day of the infection profile that is needed.
+    :return: an ndarray whose last axis has length K + 1, zero padded past the end of w.
+    """
+    if callable(w):
+        return np.array([w(s) for s in range(K + 1)], dtype = float)
+
+    w = np.asarray(w, dtype = float)
+    if w.shape[-1] >= K + 1:
+        return w[..., :K + 1]
+    padding = [(0, 0)] * (w.ndim - 1) + [(0, K + 1 - w.shape[-1])]
+    return np.pad(w, padding)
+
+def lambda_series(incidence, w):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :return: an ndarray lambdas of length T + 1 along the last axis where lambdas[..., t] == lambda_t(t, incidence, w).
+
+    Computes every lambda_t at once by convolving the incidence with w(1), ..., w(T). Leading axes of incidence and of
+    an ndarray kernel are broadcast against each other. lambdas[..., T] is the total infectiousness on the day after
+    the last reported day.
+    """
+    incidence = np.asarray(incidence, dtype = float)
+    T = incidence.shape[-1]
+    kernel = kernel_array(w, T)[..., 1:]
+
+    lambdas = np.zeros(np.broadcast_shapes(incidence.shape[:-1], kernel.shape[:-1]) + (T + 1,))
+    if T == 0:
+        return lambdas
+
+    if incidence.ndim == 1 and kernel.ndim == 1 and T <= DIRECT_CONVOLUTION_DAYS:
+        convolution = np.convolve(incidence, kernel)
+    else:
+        ndim = max(incidence.ndim, kernel.ndim)
+        incidence = incidence.reshape((1,) * (ndim - incidence.ndim) + incidence.shape)
+        kernel = kernel.reshape((1,) * (ndim - kernel.ndim) + kernel.shape)
+        convolution = np.maximum(signal.fftconvolve(incidence, kernel, axes = -1), 0) #removing round off below zero
 
+    lambdas[..., 1:] = convolution[..., :T]
+    return lambdas
 
 
-def estimate_R_t(t, pi, incidence_data, w, a = 1, b = 5, n = 1):
+
+
+def estimate_R_t(t, pi, incidence_data, w, a = 1, b = 5, n = 1, lambdas = None):
     """
     :param t: t (in days) at which to re_estimate R_t
     :param pi: the size of the window
     :param incidence_data: a list of integers. indcidence_data[s] represents the number of incident cases on day s.
     :param w: a probability density function describing the infectious profile with signature f(t) where is an integer. w(s) represents the probability of spreading the infection on day s.
     :param a, b: constants to be used in gamma distribution of a.
+    :param lambdas: optional output of lambda_series(incidence_data, w), used instead of recomputing lambda_t.
     :return: an estimate of Reproduction number on day t.
     Follwing appendix 1 of cori 2013. I_t follows a poisson distribution. (See eq. 2 of equations page)
     """
@@ -73,7 +125,10 @@ def estimate_R_t(t, pi, incidence_data, w, a = 1, b = 5, n = 1):
     summation_lambdas = 0
     for s in range(t - pi, t):
         summation += (incidence_data[s])
-        summation_lambdas += lambda_t(s, incidence_data, w)
+        if lambdas is None:
+            summation_lambdas += lambda_t(s, incidence_data, w)
+        elif s >= 0: #lambda_t is zero before the first day
+            summation_lambdas += lambdas[s]
 
     alpha = a + summation
     beta = (1/b) + summation_lambdas
@@ -89,6 +144,84 @@ def estimate_R_t(t, pi, incidence_data, w, a = 1, b = 5, n = 1):
         estimates2.append(alpha/beta)
     return vals, estimates2[0]
 
+def posterior_R_t_parameters(incidence, w, window, a = 1, b = 5, lambdas = None):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param window: the size of the window
+    :param a, b: constants to be used in gamma distribution of a.
+    :param lambdas: optional output of lambda_series(incidence, w).
+    :return: alpha, beta. The shape and rate of the gamma posterior of R_t for t in 0, ..., T along the last axis.
+
+    The window sums are differences of cumulative sums of the incidence and of lambda. alpha follows the shape of the
+    incidence and beta the shape of lambdas, so one incidence series can be paired with many serial intervals.
+    """
+    incidence = np.asarray(incidence, dtype = float)
+    if lambdas is None:
+        lambdas = lambda_series(incidence, w)
+    T = incidence.shape[-1]
+
+    zeros = np.zeros(incidence.shape[:-1] + (1,))
+    cumulative_incidence = np.concatenate((zeros, np.cumsum(incidence, axis = -1)), axis = -1)
+    zeros = np.zeros(lambdas.shape[:-1] + (1,))
+    cumulative_lambdas = np.concatenate((zeros, np.cumsum(lambdas[..., :T], axis = -1)), axis = -1)
+
+    t = np.arange(T + 1)
+    window_start = np.maximum(t - window, 0)
+    alpha = a + cumulative_incidence[..., t] - cumulative_incidence[..., window_start]
+    beta = (1/b) + cumulative_lambdas[..., t] - cumulative_lambdas[..., window_start]
+    return alpha, beta
+
+def estimate_R_t_series(incidence, w, window, a = 1, b = 5, quantiles = (0.025, 0.975), lambdas = None):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param window: the size of the window
+    :param a, b: constants to be used in gamma distribution of a.
+    :param quantiles: the quantiles of the posterior to return.
+    :param lambdas: optional output of lambda_series(incidence, w).
+    :return: means, an ndarray of length T + 1 along the last axis where means[..., t] is the mean estimate of R_t, and
+    intervals, an ndarray of shape (len(quantiles),) + means.shape holding the requested quantiles.
+
+    Same posterior as estimate_R_t for every t in 0, ..., T at once. The window sums of incidence and lambda are taken
+    from cumulative sums, and all the quantiles come from a single stats.gamma.ppf call. Days before the first full
+    window use the days available instead of wrapping around to the end of the series.
+    """
+    alpha, beta = posterior_R_t_parameters(incidence, w, window, a = a, b = b, lambdas = lambdas)
+    alpha, beta = np.broadcast_arrays(alpha, beta)
+
+    means = alpha / beta
+    quantiles = np.asarray(quantiles, dtype = float).reshape((-1,) + (1,) * means.ndim)
+    intervals = stats.gamma.ppf(quantiles, a = alpha, scale = 1/beta)
+    return means, intervals
+
+def infection_profile_kernel(mean, std_deviation, K):
+    """
+    :param mean: mean of the gamma distribution that the infection profile follows, a float or an array.
+    :param std_deviation: std_deviation of the gamma distribution that the infection profile follows, a float or an array.
+    :param K: the last day of the infection profile to compute.
+    :return: an ndarray of shape broadcast(mean, std_deviation).shape + (K + 1,) where kernel[..., s] is the descritized
+    probability of the infection profile at day s.
+
+    Following shifted gamma distribution on appendix 11. All the gamma cdfs needed for days 0 to K, and for every pair
+    of mean and std_deviation, are evaluated in a single call instead of six scalar calls per day.
+    """
+
+    mean = np.asarray(mean, dtype = float)[..., np.newaxis]
+    std_deviation = np.asarray(std_deviation, dtype = float)[..., np.newaxis]
+    beta = mean / (std_deviation ** 2) #since, mean = alpha/beta and variance = alpha/(beta^2)
+    alpha = mean * beta
+    alpha, beta = np.broadcast_arrays(alpha, beta)
+
+    s = np.arange(K + 1) + 1 #the closure shifts s by one day
+    points = np.arange(-1, K + 2) #covers s - 2, s - 1 and s for every day
+    cdfs = stats.gamma.cdf(points, a = np.stack((alpha, alpha + 1)), scale = 1/beta)
+    cdf, cdf_shape_plus_one = cdfs[0], cdfs[1]
+
+    kernel = (s * cdf[..., 2:]) + ((s - 2) * cdf[..., :-2]) - (2 * (s - 1) * cdf[..., 1:-1]) + \
+             ((alpha * 1/beta) * (2 * cdf_shape_plus_one[..., 1:-1] - cdf_shape_plus_one[..., :-2] - cdf_shape_plus_one[..., 2:]))
+    return kernel
+
 def infection_profile(mean, std_deviation):
     """
     :param mean: mean of the gamma distribution that the infection profile follows.
@@ -96,26 +229,20 @@ def infection_profile(mean, std_deviation):
     :param s: day at which to determine probability.
     :return: descritized probability of the infection profile at day s.
 
-    Following shifted gamma distribution on appendix 11
+    Following shifted gamma distribution on appendix 11. Thin wrapper around infection_profile_kernel, the kernel is
+    doubled in length whenever a day past its end is requested.
     """
 
-    beta = mean / (std_deviation ** 2) #since, mean = alpha/beta and variance = alpha/(beta^2)
-    alpha = mean * beta
-
-    probs = {}
+    kernel = infection_profile_kernel(mean, std_deviation, 64)
     def prob(s):
+        nonlocal kernel
         int_s = int(s)
         assert np.allclose([int_s], [s])  # making sure s is an integer
-        s += 1
-        if s in probs:
-            return probs[s]
-        else:
-            prob = (np.convolve(s,stats.gamma.cdf(s, a = alpha, scale = 1/beta))) + (np.convolve((s - 2), stats.gamma.cdf(s - 2, a = alpha, scale = 1/beta)) ) - \
-                   (np.convolve(2,  np.convolve((s - 1) , stats.gamma.cdf(s - 1, a = alpha, scale = 1/beta)))) + \
-                   ((alpha * 1/beta)*(2*(stats.gamma.cdf(s-1, a = alpha + 1, scale = 1/beta))- stats.gamma.cdf(s - 2, a = alpha + 1, scale = 1/beta) - \
-                                      stats.gamma.cdf(s, a = alpha + 1, scale = 1/beta)))
-        probs[s] = prob[0]
-        return prob[0]
+        if int_s < 0:
+            return 0.0
+        if int_s >= len(kernel):
+            kernel = infection_profile_kernel(mean, std_deviation, 2 * int_s)
+        return kernel[int_s]
     return prob
 
 
@@ -168,17 +295,8 @@ def model_epidemic(data_file, prior_rt, mean_si, sd_si, window = 1):
             day = 7
             break
 
-    estimates_of_R_t = []
-    for t in range(T):
-        estimates_of_R_t.append(estimate_R_t(t, 7, incidence_data = incidence_data, w = w, n = 100))
-
-
-    means, start, end = [],[],[]
-    for i in range(T):
-        m = estimates_of_R_t[i][-1]
-        means.append(m)
-        start.append(estimates_of_R_t[i][0][0])
-        end.append(estimates_of_R_t[i][0][1])
+    means, (start, end) = estimate_R_t_series(incidence_data, w, 7)
+    means, start, end = means[:T], start[:T], end[:T]
 
     #print(start)
     #print(end)
@@ -189,48 +307,98 @@ def model_epidemic(data_file, prior_rt, mean_si, sd_si, window = 1):
     plt.ylabel("R_t")
     plt.show()
 
-def simulate_i_t_and_r_t():
+def simulate_epidemics(instant_R_t, w, T, n_epidemics, initial_incidence = 10, rng = None):
+    """
+    :param instant_R_t: the reproduction number, either an array whose last axis holds R_t for t in 0, ..., T (leading
+    axes broadcast against the epidemics) or a function of the form f(t).
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param T: the last day to simulate.
+    :param n_epidemics: the number of epidemics simulated together.
+    :param initial_incidence: the number of incident cases on day 0.
+    :param rng: a numpy.random.Generator, a new unseeded one is used by default.
+    :return: an ndarray of shape (n_epidemics, T + 1), incidence[n, t] is the number of cases of epidemic n on day t.
+
+    Follwing appendix 1 of cori 2013, I_t follows a poisson distribution with mean R_t * lambda_t (See eq. 1 of equations
+    page). All the epidemics advance one day at a time, lambda_t for every epidemic is a single product of the incidence
+    so far with the kernel and the new cases are one vectorized poisson draw.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    if callable(instant_R_t):
+        instant_R_t = np.array([instant_R_t(t) for t in range(T + 1)], dtype = float)
+    instant_R_t = np.broadcast_to(np.asarray(instant_R_t, dtype = float), (n_epidemics, T + 1))
+    kernel = kernel_array(w, T)
+
+    incidence = np.zeros((T + 1, n_epidemics)) #day major, so each day is a contiguous row
+    incidence[0] = initial_incidence
+    for t in range(1, T + 1):
+        lambdas = kernel[t:0:-1] @ incidence[:t] #w(t), ..., w(1) against the incidence of days 0, ..., t - 1
+        incidence[t] = rng.poisson(instant_R_t[:, t] * lambdas)
+    return incidence.T.astype(np.int64)
+
+def under_reporting_sweep(incidence, probs, w, window, a = 1, b = 5, quantiles = (0.025, 0.975), band_quantiles = (0.05, 0.5, 0.95), rng = None):
+    """
+    :param incidence: an array of shape (n_epidemics, T + 1) with the true incidence of every epidemic.
+    :param probs: the reporting probabilities to sweep over.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param window: the size of the window
+    :param a, b: constants to be used in gamma distribution of a.
+    :param quantiles: the credible interval of every R_t posterior.
+    :param band_quantiles: quantiles of the mean estimates across epidemics.
+    :param rng: a numpy.random.Generator, a new unseeded one is used by default.
+    :return: means, of shape (len(probs), n_epidemics, T + 2), the mean estimate of R_t for t in 0, ..., T + 1 from the
+    reported cases of every epidemic. starts and ends, of shape (len(probs), T + 2), the lowest start and the highest
+    end of the credible intervals across epidemics. bands, of shape (len(band_quantiles), len(probs), T + 2).
+
+    Every epidemic is thinned with every reporting probability in a single binomial draw, then lambda and the R_t
+    posteriors of the whole (probs x epidemics x days) tensor are computed in one batch.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    probs = np.asarray(probs, dtype = float)
+    incidence = np.asarray(incidence)
+
+    reported_cases = rng.binomial(incidence[np.newaxis], probs[:, np.newaxis, np.newaxis])
+    means, intervals = estimate_R_t_series(reported_cases, w, window, a = a, b = b, quantiles = quantiles)
+
+    starts = np.min(intervals[0], axis = 1)
+    ends = np.max(intervals[-1], axis = 1)
+    bands = np.quantile(means, band_quantiles, axis = 1)
+    return means, starts, ends, bands
+
+def plot_under_reporting_sweep(axs, probs, days, means, starts, ends):
+    """
+    :param axs: one surface per reporting probability to plot on.
+    :param probs: the reporting probabilities of the sweep.
+    :param days: the days to plot, indexes into the last axis of the outputs of under_reporting_sweep.
+    :param means, starts, ends: outputs of under_reporting_sweep.
+    """
+    for i in range(len(probs)):
+        plot_surface = axs[i]
+        plot_surface.fill_between(days, starts[i, days], ends[i, days], color="black", alpha=0.25)
+        plot_surface.plot(days, means[i][:, days].T, color = "black")
+        #plot_surface.set_xlabel("Days (T)")
+        plot_surface.set_ylabel("Instant R_t")
+        plot_surface.set_title("p = " + str(round(probs[i], 2)))
+        plot_surface.set_ylim(bottom = 0, top = 20)
+
+def simulate_i_t_and_r_t(rng = None):
     T = 50
     pandemics = 100
     window_size = 7
     min_day = []
 
-    incidence_aross_pandemics = []
     mean = 8.4
     std_deviation = 3.8
     w = infection_profile(mean, std_deviation)
-    starts = [[] for i in range(T)]
-    ends = [[] for i in range(T)]
-    means = [[] for i in range(pandemics)]
-
-    for pandemic_num in range(pandemics):
-        incidence_data = [10]
-        day_found = False
-        probs = []
-        reproduction_number = []
 
-        for t in range(1, T + 1):
+    incidence_aross_pandemics = simulate_epidemics(prior_instant_R_t, w, T, pandemics, initial_incidence = 10, rng = rng)
 
-            I_t = estimate_I_t(t, prior_instant_R_t, incidence_data, w)
-            incidence_data.append(I_t)
+    #first day from window_size on with more than 11 cases after the initial 10
+    day_found = (np.cumsum(incidence_aross_pandemics, axis = 1) > (11 + 10)) & (np.arange(T + 1) >= window_size)
+    min_day = list(np.argmax(day_found, axis = 1)[np.any(day_found, axis = 1)])
 
-            if t > window_size:
-                reproduction_number.append(estimate_R_t(t, pi=window_size, incidence_data=incidence_data, w=w))
-
-            if not day_found and sum(incidence_data) > (11 + 10) and t >= window_size:
-                min_day.append(t)
-                day_found = True
-
-        for j in range(len(reproduction_number)):
-            starts[j].append(reproduction_number[j][0][0])
-            ends[j].append(reproduction_number[j][0][1])
-            means[pandemic_num].append(reproduction_number[j][1])
-
-
-
-
-        incidence_aross_pandemics.append(incidence_data)
-        plt.scatter(range(T + 1), incidence_data, marker='x', color='black')
+    plt.scatter(np.tile(range(T + 1), pandemics), incidence_aross_pandemics.ravel(), marker='x', color='black')
     plt.show()
     start_day = max(min_day)
     fig, axs = plt.subplots(3, 3)
@@ -252,49 +420,17 @@ def simulate_i_t_and_r_t():
 
     probs = [1.0 - (0.1 * i) for i in range(9)]
 
+    means, starts, ends, _ = under_reporting_sweep(incidence_aross_pandemics, probs, w, window_size, rng = rng)
 
+    #estimates of R_t on days window_size + 1, ..., T, starting at the latest epidemic start
+    start_day = max(start_day - window_size, 0)
+    days = np.arange(window_size + 1 + start_day, T + 1)
+    plot_under_reporting_sweep(axs.ravel(), probs, days, means, starts, ends)
+    plt.show()
+    # plt.plot(days[max(min_day):], means[max(min_day):], color = "black")
 
 
-    for i in range(len(probs)):
-        p = probs[i]
-        starts = [[] for i in range(window_size + 1, T + 1)]
-        ends = [[] for i in range(window_size + 1, T + 1)]
-        means = [[] for i in range(pandemics)]
-
-
-        for pandemic_num in range(pandemics):
-            incidence_data = incidence_aross_pandemics[pandemic_num]
-            reported_cases = [np.random.binomial(i, p) for i in incidence_data]
-
-
-            reproduction_number = []
-            for t in range(1, T + 1):
-                if t > window_size:
-                    reproduction_number.append(estimate_R_t(t, pi = window_size, incidence_data = reported_cases, w=w))
-
-            for j in range(len(reproduction_number)):
-                starts[j].append(reproduction_number[j][0][0])
-                ends[j].append(reproduction_number[j][0][1])
-                means[pandemic_num].append(reproduction_number[j][1])
-
-        start_day = max(min_day)
-        start_day = start_day - window_size
-
-        if start_day < 0:
-            start_day = 0
-        starts = [np.min(i) for i in starts]
-        ends = [np.max(i) for i in ends]
-
 
-        axs[i // 3, i % 3].fill_between(list(range(window_size, T))[start_day:], starts[start_day:], ends[start_day:], color="black", alpha=0.25)
-        for mean in range(len(means)):
-            axs[i // 3, i % 3].plot(list(range(window_size, T))[start_day:], means[mean][start_day:], color = "black")
-        #axs[i // 3, i % 3].set_xlabel("Days (T)")
-        axs[i // 3, i % 3].set_ylabel("Instant R_t")
-        axs[i // 3, i % 3].set_title("p = " + str(round(p, 2)))
-        axs[i // 3, i % 3].set_ylim(bottom = 0, top = 20)
-    plt.show()
-    # plt.plot(days[max(min_day):], means[max(min_day):], color = "black")
 
 
 
@@ -303,84 +439,103 @@ def simulate_i_t_and_r_t():
 
 
 
+def combine_moments(count, mean, m2, samples):
+    """
+    :param count, mean, m2: running count, mean and sum of squared deviations from the mean.
+    :param samples: an ndarray of new samples.
+    :return: count, mean, m2 including the new samples.
 
+    Chan et al. parallel update, so the samples can be streamed in chunks without being kept in memory.
+    """
+    samples_count = samples.size
+    samples_mean = np.mean(samples)
+    samples_m2 = np.sum((samples - samples_mean) ** 2)
 
+    total = count + samples_count
+    delta = samples_mean - mean
+    mean = mean + delta * samples_count / total
+    m2 = m2 + samples_m2 + (delta ** 2) * count * samples_count / total
+    return total, mean, m2
 
-def estimate_i_t_and_r_t():
+def appendix_6_engine(T = 50, N = 200, mean = 8.4, std_deviation = 3.8, window = 1, intervals = (0.10, 0.30, 0.50), initial_incidence = (0, 10), a = 1, b = 5, chunk_size = 64, rng = None):
+    """
+    :param T: the last day to simulate.
+    :param N: the number of sampled serial intervals, each contributes N draws from the posterior of R_t.
+    :param mean, std_deviation: the serial interval means are drawn from normal(mean, 1.5) and the standard deviations
+    from normal(std_deviation, 0.5), redrawn until they are not larger than the mean.
+    :param window: the size of the window
+    :param intervals: confidence levels of the intervals around the mean of R_t.
+    :param initial_incidence: the incident cases of the first days.
+    :param a, b: constants to be used in gamma distribution of a.
+    :param chunk_size: the number of serial intervals whose posterior draws are held in memory at once.
+    :param rng: a numpy.random.Generator, a new unseeded one is used by default.
+    :return: days, the simulated days. incidence, an ndarray of length T + 1. means, of the N * N estimates of R_t on
+    every day. starts and ends, of shape (len(intervals), len(days)). min_day, the first day with more than 12 cases so
+    far, or None.
+
+    Following appendix 6. All N serial intervals are drawn at once and turned into one kernel bank which is reused
+    every day. Every day, lambda_t for the whole bank is one matrix product, the N incidence samples are one poisson
+    draw and their mean is the incidence of the day. The mean and standard error of the N * N posterior draws of R_t are
+    accumulated chunk by chunk instead of keeping an N x N buffer. Days without a full window get nan.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    means_si = rng.normal(loc = mean, scale = 1.5, size = N)
+    stds_si = rng.normal(loc = std_deviation, scale = 0.5, size = N)
+    rejected = stds_si > means_si
+    while np.any(rejected):
+        stds_si[rejected] = rng.normal(loc = std_deviation, scale = 0.5, size = np.count_nonzero(rejected))
+        rejected = stds_si > means_si
+    kernels = infection_profile_kernel(means_si, stds_si, T) #one row per serial interval
+
+    incidence = np.zeros(T + 1)
+    incidence[:len(initial_incidence)] = initial_incidence
+    lambdas = np.zeros((N, T + 1))
+    for t in range(1, len(initial_incidence)):
+        lambdas[:, t] = kernels[:, t:0:-1] @ incidence[:t]
+
+    days = np.arange(len(initial_incidence), T + 1)
+    means = np.full(len(days), np.nan)
+    std_errors = np.full(len(days), np.nan)
+    for day_num, t in enumerate(days):
+        lambdas[:, t] = kernels[:, t:0:-1] @ incidence[:t] #w(t), ..., w(1) against the incidence of days 0, ..., t - 1
+        i_t_estimates = rng.poisson(prior_instant_R_t(t) * lambdas[:, t])
+        incidence[t] = np.mean(i_t_estimates)
+
+        if t > window:
+            alpha = a + np.sum(incidence[t - window:t])
+            beta = (1/b) + np.sum(lambdas[:, t - window:t], axis = 1)
+            count, mean_r_t, m2 = 0, 0.0, 0.0
+            for chunk_start in range(0, N, chunk_size):
+                chunk_beta = beta[chunk_start:chunk_start + chunk_size, np.newaxis]
+                r_t_estimates = rng.gamma(alpha, 1 / chunk_beta, size = (len(chunk_beta), N))
+                count, mean_r_t, m2 = combine_moments(count, mean_r_t, m2, r_t_estimates)
+            means[day_num] = mean_r_t
+            std_errors[day_num] = np.sqrt(m2 / (count - 1)) / np.sqrt(count)
+
+    levels = np.asarray(intervals, dtype = float)[:, np.newaxis]
+    h = std_errors * stats.t.ppf((1 + levels) / 2, (N * N) - 1)
+    starts, ends = means - h, means + h
+
+    reached = np.nonzero(np.cumsum(incidence)[days] > 12)[0]
+    min_day = days[reached[0]] if len(reached) else None
+    return days, incidence, means, starts, ends, min_day
+
+def estimate_i_t_and_r_t(rng = None):
     """Following appendix 6"""
 
     T = 50
-    pandemics = 1
     window_size = 1
     N = 200
-    incidence_across_simulations = [[] for i in range(1, T + 1)]
-    reproduction_across_simulations = [[] for i in range(window_size, T + 1)]
-    min_day = []
-
-    means = []
-    start = [[], [], []]
-    end = [[], [], []]
-    days = []
     intervals = [0.10, 0.30, 0.50]
 
-    for i in range(pandemics):
-        mean = 8.4
-        std_deviation = 3.8
-        incidence_data = [0, 10]
-        w = infection_profile(mean, std_deviation)
-        reproduction_number = [0]
-        day_found = False
-        probs = []
-
-        for t in range(10):
-            probs.append(w(t))
-
-        for t in range(2, T + 1):
-
-            i_t_estimates = []
-            r_t_estimates = np.zeros((N, N))
-            for iter_num in range(N):
-                print(t, iter_num)
-                r_t_estimates_mean_constant = []
-                current_incidence = incidence_data.copy()
-                mean_si = np.random.normal(loc=mean, scale=1.5)
-                std_si = math.inf
-
-                while std_si > mean_si:
-                    std_si = np.random.normal(loc=std_deviation, scale=0.5)
-                w = infection_profile(mean_si, std_si)
-
-                current_incidence.append(
-                    estimate_I_t(t, instant_R_t=prior_instant_R_t, w=w, incidence_data=current_incidence))
-
-                if t > window_size:
-                    r_t_estimates[iter_num] = (estimate_R_t(t, window_size, incidence_data=current_incidence, w=w, n=N))
-
-                i_t_estimates.append(current_incidence[-1])
-
-            incidence_data.append(np.mean(i_t_estimates))
-            if not day_found and np.sum(current_incidence) > 12:
-                min_day.append(t)
-                day_found = not day_found
-
-            for i in range(len(intervals)):
-                confidence = intervals[i]
-                data = np.ndarray.flatten(r_t_estimates)
-                m = np.mean(data)
-                std_err = stats.sem(data)
-                h = std_err * stats.t.ppf((1 + confidence) / 2, (N * N) - 1)
-                start[i].append(m - h)
-                end[i].append(m + h)
-            days.append(t)
-            if t > 7:
-                pass
-                # plt.scatter([t] * (N * N), np.ndarray.flatten(r_t_estimates), color = "black", marker='x', s = 0.1)
-
-    print(days)
-    print(start)
+    days, incidence_data, means, start, end, min_day = appendix_6_engine(T = T, N = N, mean = 8.4, std_deviation = 3.8, window = window_size, intervals = intervals, rng = rng)
+    min_day = days[0] if min_day is None else min_day
+    plotted = days >= min_day
 
     for i in range(len(intervals)):
-        plt.fill_between(days[max(min_day):], start[i][max(min_day):], end[i][max(min_day):], alpha=1,
+        plt.fill_between(days[plotted], start[i][plotted], end[i][plotted], alpha=1,
                          label=str(intervals[i] * 100) + "%")
 
         plt.xlabel("Time (Days)")
@@ -1,9 +1,19 @@
 import numpy as np
-from scipy import stats, spatial
-import matplotlib.pyplot as plt
-import math
+from scipy import stats, signal, special
 import datetime
-import matplotlib.dates as mdates
+import os
+import csv
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import incidence_store
+import nowcasting
+import profiling
+
+DIRECT_CONVOLUTION_DAYS = 500 #series longer than this are convolved with FFT
+DIRECT_KERNEL_DAYS = 128 #single series are convolved directly, in O(T * K), with kernels up to this many days
+KERNEL_TOLERANCE = 1e-6 #mass of the tail of w(t) that truncated kernels may discard
 
 
 
@@ -16,26 +26,31 @@ def prior_instant_R_t(t):
         return 2.5
     return 0.7
 
-def predict_I_t(t, r_t, incidence_data, w):
+def predict_I_t(t, r_t, incidence_data, w, lambdas = None):
     """
     :param t: the time t at which to predict
     :param r_t: reproduction number on the previous day
     :param incidence_data: previous reported cases
     :param w: infectious profile, having signature w(t)
+    :param lambdas: optional output of lambda_series(incidence_data, w), used instead of recomputing lambda_t.
     :return: confidence interval of the estimate of cases, the mean of the estimate
     """
-    summation = lambda_t(t, incidence_data, w)
+    if lambdas is None:
+        summation = lambda_t(t, incidence_data, w)
+    else:
+        summation = lambdas[t]
 
     prediction = r_t * summation
     conf = stats.poisson.interval(0.95, prediction)
     return conf, prediction
 
-def estimate_I_t(t, instant_R_t, incidence_data, w):
+def estimate_I_t(t, instant_R_t, incidence_data, w, lambdas = None):
     '''
     :param t: t (in days) at which to estimate I_t
     :param instant_R_t: a function of the form f(t) which returns the reproduction number at a given time t.
     :param incidence_data: a list of integers. indcidence_data[s] represents the number of incident cases on day s.
     :param w: a probability density function describing the infectious profile with signature f(t) where is an integer. w(s) represents the probability of spreading the infection on day s.
+    :param lambdas: optional output of lambda_series(incidence_data, w), used instead of recomputing lambda_t.
     :return: prediction of the number of incidence cases on day t.
 
     Follwing appendix 1 of cori 2013. I_t follows a poisson distribution. (See eq. 1 of equations page)
@@ -45,7 +60,10 @@ def estimate_I_t(t, instant_R_t, incidence_data, w):
     #for s in range(t):
     #    summation += (incidence_data[s] * w(s))
 
-    summation = lambda_t(t, incidence_data, w)
+    if lambdas is None:
+        summation = lambda_t(t, incidence_data, w)
+    else:
+        summation = lambdas[t]
 
 
     mean = prior_instant_R_t(t) * summation #mean of poisson distribution
@@ -57,35 +75,92 @@ def lambda_t(t, incidence_data, w):
     """
     :param indidence_data: a list of integers. indcidence_data[s] represents the number of incident cases on day s.
     :param w: a probability density function describing the infectious profile with signature f(t) where is an integer. w(s) represents the probability of spreading the infection on day s.
+    Or an ndarray kernel, then only the days it covers are summed.
     :return: a float representing the summation
 
     Following appendex 1 of cori 2013. See (eq.3 of equations)
     """
+    if not callable(w):
+        K = min(t, len(w) - 1)
+        if K <= 0:
+            return 0.0
+        return float(np.dot(w[K:0:-1], incidence_data[t - K:t])) #w(K), ..., w(1) against the K days before t
     summation = 0
     for s in range(1, t+1):
         summation += (incidence_data[t-s] * w(s))
 
     return summation
 
+def kernel_array(w, K):
+    """
+    :param w: infectious profile, either an ndarray from infection_profile_kernel (kernel[..., s] is the probability
+    at day s) or a function with signature w(t).
+    :param K: the last day of the infection profile that is needed.
+    :return: an ndarray whose last axis has length K + 1, zero padded past the end of w.
+    """
+    if callable(w):
+        return np.array([w(s) for s in range(K + 1)], dtype = float)
+
+    w = np.asarray(w, dtype = float)
+    if w.shape[-1] >= K + 1:
+        return w[..., :K + 1]
+    padding = [(0, 0)] * (w.ndim - 1) + [(0, K + 1 - w.shape[-1])]
+    return np.pad(w, padding)
+
+def lambda_series(incidence, w):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :return: an ndarray lambdas of length T + 1 along the last axis where lambdas[..., t] == lambda_t(t, incidence, w).
+
+    Computes every lambda_t at once by convolving the incidence with w(1), ..., w(T). Leading axes of incidence and of
+    an ndarray kernel are broadcast against each other. lambdas[..., T] is the total infectiousness on the day after
+    the last reported day. An ndarray kernel of K days shorter than the series is not padded, so a single series with
+    a truncated kernel costs O(T * K) and batches are transformed over T + K days instead of 2T.
+    """
+    profiling.count("lambda_series")
+    incidence = np.asarray(incidence, dtype = float)
+    T = incidence.shape[-1]
+    K = T if callable(w) else min(T, np.shape(w)[-1] - 1)
+    kernel = kernel_array(w, K)[..., 1:]
+
+    lambdas = np.zeros(np.broadcast_shapes(incidence.shape[:-1], kernel.shape[:-1]) + (T + 1,))
+    if T == 0 or K <= 0:
+        return lambdas
+
+    if incidence.ndim == 1 and kernel.ndim == 1 and (T <= DIRECT_CONVOLUTION_DAYS or K <= DIRECT_KERNEL_DAYS):
+        convolution = np.convolve(incidence, kernel)
+    else:
+        ndim = max(incidence.ndim, kernel.ndim)
+        incidence = incidence.reshape((1,) * (ndim - incidence.ndim) + incidence.shape)
+        kernel = kernel.reshape((1,) * (ndim - kernel.ndim) + kernel.shape)
+        convolution = np.maximum(signal.fftconvolve(incidence, kernel, axes = -1), 0) #removing round off below zero
+
+    lambdas[..., 1:] = convolution[..., :T]
+    return lambdas
+
 
 
 
-def estimate_R_t(t, pi, incidence_data, w, a = 1, b = 5, n = 1, sample = False):
+def estimate_R_t(t, pi, incidence_data, w, a = 1, b = 5, n = 1, lambdas = None, sample = False):
     """
     :param t: t (in days) at which to re_estimate R_t
     :param pi: the size of the window
     :param incidence_data: a list of integers. indcidence_data[s] represents the number of incident cases on day s.
     :param w: a probability density function describing the infectious profile with signature f(t) where is an integer. w(s) represents the probability of spreading the infection on day s.
     :param a, b: constants to be used in gamma distribution of a.
+    :param lambdas: optional output of lambda_series(incidence_data, w), used instead of recomputing lambda_t.
     :return: an estimate of Reproduction number on day t.
     Follwing appendix 1 of cori 2013. I_t follows a poisson distribution. (See eq. 2 of equations page)
     """
-
     summation = 0
     summation_lambdas = 0
     for s in range(t - pi, t):
         summation += (incidence_data[s])
-        summation_lambdas += lambda_t(s, incidence_data, w)
+        if lambdas is None:
+            summation_lambdas += lambda_t(s, incidence_data, w)
+        elif s >= 0: #lambda_t is zero before the first day
+            summation_lambdas += lambdas[s]
 
     alpha = a + summation
     beta = (1/b) + summation_lambdas
@@ -102,6 +177,296 @@ def estimate_R_t(t, pi, incidence_data, w, a = 1, b = 5, n = 1, sample = False):
         return estimates
     return vals, estimates2[0]
 
+def posterior_R_t_parameters(incidence, w, window, a = 1, b = 5, lambdas = None):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param window: the size of the window
+    :param a, b: constants to be used in gamma distribution of a.
+    :param lambdas: optional output of lambda_series(incidence, w).
+    :return: alpha, beta. The shape and rate of the gamma posterior of R_t for t in 0, ..., T along the last axis.
+
+    The window sums are differences of cumulative sums of the incidence and of lambda. alpha follows the shape of the
+    incidence and beta the shape of lambdas, so one incidence series can be paired with many serial intervals.
+    """
+    incidence = np.asarray(incidence, dtype = float)
+    if lambdas is None:
+        lambdas = lambda_series(incidence, w)
+    T = incidence.shape[-1]
+
+    zeros = np.zeros(incidence.shape[:-1] + (1,))
+    cumulative_incidence = np.concatenate((zeros, np.cumsum(incidence, axis = -1)), axis = -1)
+    zeros = np.zeros(lambdas.shape[:-1] + (1,))
+    cumulative_lambdas = np.concatenate((zeros, np.cumsum(lambdas[..., :T], axis = -1)), axis = -1)
+
+    t = np.arange(T + 1)
+    window_start = np.maximum(t - window, 0)
+    alpha = a + cumulative_incidence[..., t] - cumulative_incidence[..., window_start]
+    beta = (1/b) + cumulative_lambdas[..., t] - cumulative_lambdas[..., window_start]
+    return alpha, beta
+
+def estimate_R_t_series(incidence, w, window, a = 1, b = 5, quantiles = (0.025, 0.975), lambdas = None, starts = None):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param window: the size of the window
+    :param a, b: constants to be used in gamma distribution of a.
+    :param quantiles: the quantiles of the posterior to return.
+    :param lambdas: optional output of lambda_series(incidence, w).
+    :param starts: optional first day of the series of every region, for a (regions x days) matrix whose series start
+    on different days. A number or an array of the leading shape of incidence.
+    :return: means, an ndarray of length T + 1 along the last axis where means[..., t] is the mean estimate of R_t, and
+    intervals, an ndarray of shape (len(quantiles),) + means.shape holding the requested quantiles.
+
+    Same posterior as estimate_R_t for every t in 0, ..., T at once. The window sums of incidence and lambda are taken
+    from cumulative sums, and all the quantiles come from a single stats.gamma.ppf call. Days before the first full
+    window use the days available instead of wrapping around to the end of the series. With starts, R_t is nan until
+    the first full window of every series, so a matrix of every region is estimated in one call.
+    """
+    profiling.count("estimate_R_t_series")
+    alpha, beta = posterior_R_t_parameters(incidence, w, window, a = a, b = b, lambdas = lambdas)
+    alpha, beta = np.broadcast_arrays(alpha, beta)
+
+    means = alpha / beta
+    quantiles = np.asarray(quantiles, dtype = float).reshape((-1,) + (1,) * means.ndim)
+    intervals = stats.gamma.ppf(quantiles, a = alpha, scale = 1/beta)
+    if starts is not None:
+        masked = before_first_window(means.shape[-1], starts, window)
+        means, intervals = np.where(masked, np.nan, means), np.where(masked, np.nan, intervals)
+    return means, intervals
+
+
+def before_first_window(days, starts, window):
+    """
+    :param days: the number of days along the last axis.
+    :param starts: the first day of the series of every region, a number or an array.
+    :return: a boolean array of shape starts.shape + (days,), True on the days before the first full window of every
+    series, that is before starts + window.
+    """
+    return np.arange(days) < np.asarray(starts)[..., np.newaxis] + window
+
+def forecast_distributions(incidence, w, window, horizons = 7, a = 1, b = 5, lambdas = None):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param window: the size of the window
+    :param horizons: the number of days ahead to forecast from every cutoff.
+    :param a, b: constants to be used in gamma distribution of a.
+    :param lambdas: optional output of lambda_series(incidence, w).
+    :return: n, p and means, each of shape (..., horizons, T - window). For the cutoff c = window + j, only days before
+    c are known and [..., h - 1, j] describes the forecast of day c + h - 1 as a negative binomial(n, p) with the given
+    mean. Forecasts past the last day are nan.
+
+    R_t is the posterior at the cutoff, the posterior gamma mixed with the poisson of eq. 1 gives the negative binomial.
+    Beyond one day ahead, the unknown days entering lambda are replaced by their expected values, so the k-step
+    forecasts carry the uncertainty of R_t but not the noise of the intermediate days. Every cutoff is computed at once,
+    the only loop is over the horizons.
+    """
+    incidence = np.asarray(incidence, dtype = float)
+    if lambdas is None:
+        lambdas = lambda_series(incidence, w)
+    alpha, beta = posterior_R_t_parameters(incidence, w, window, a = a, b = b, lambdas = lambdas)
+    T = incidence.shape[-1]
+    kernel = kernel_array(w, horizons)
+
+    padding = [(0, 0)] * (incidence.ndim - 1) + [(0, horizons)]
+    incidence = np.pad(incidence, padding)
+    lambdas = np.pad(lambdas, padding)
+    cutoffs = np.arange(window, T)
+    alpha, beta = alpha[..., cutoffs], beta[..., cutoffs]
+    r_t = alpha / beta
+
+    expected, expected_lambdas = [], []
+    for h in range(1, horizons + 1):
+        day = cutoffs + h - 1
+        lambdas_h = lambdas[..., day]
+        for s in range(1, h): #swapping the days after the cutoff for their expected values
+            lambdas_h = lambdas_h + (expected[h - s - 1] - incidence[..., day - s]) * kernel[..., s:s + 1]
+        expected_lambdas.append(lambdas_h)
+        expected.append(r_t * lambdas_h)
+
+    means = np.stack(expected, axis = -2)
+    expected_lambdas = np.stack(expected_lambdas, axis = -2)
+    n = np.broadcast_to(alpha[..., np.newaxis, :], means.shape)
+    p = beta[..., np.newaxis, :] / (beta[..., np.newaxis, :] + expected_lambdas)
+    beyond = cutoffs + np.arange(horizons)[:, np.newaxis] >= T
+    return np.where(beyond, np.nan, n), np.where(beyond, np.nan, p), np.where(beyond, np.nan, means)
+
+def backtest_forecasts(incidence, w, window, horizons = 7, a = 1, b = 5, level = 0.95, start_day = None, lambdas = None):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s. Leading
+    axes, e.g. regions, are backtested together.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param window: the size of the window
+    :param horizons: the number of days ahead to forecast from every cutoff.
+    :param a, b: constants to be used in gamma distribution of a.
+    :param level: the level of the forecast intervals whose coverage is measured.
+    :param start_day: the first forecast day to score, window by default.
+    :param lambdas: optional output of lambda_series(incidence, w).
+    :return: coverage, mae and log_score, each of shape (..., horizons). Row h - 1 summarises the forecasts made h days
+    ahead from every possible cutoff: the fraction of reported cases inside the interval, the mean absolute error of the
+    mean forecast and the mean log predictive probability.
+
+    Days with negative counts (corrections in the reports) are not scored.
+    """
+    incidence = np.asarray(incidence, dtype = float)
+    n, p, means = forecast_distributions(incidence, w, window, horizons = horizons, a = a, b = b, lambdas = lambdas)
+    T = incidence.shape[-1]
+    start_day = window if start_day is None else start_day
+
+    day = np.arange(window, T) + np.arange(horizons)[:, np.newaxis]
+    observed = np.pad(incidence, [(0, 0)] * (incidence.ndim - 1) + [(0, horizons)])[..., day]
+    scored = ~np.isnan(means) & (day >= start_day) & (observed >= 0)
+
+    lower = stats.nbinom.ppf((1 - level) / 2, n, p)
+    upper = stats.nbinom.ppf((1 + level) / 2, n, p)
+    inside = (observed >= lower) & (observed <= upper)
+    count = np.sum(scored, axis = -1)
+    coverage = np.sum(inside & scored, axis = -1) / count
+    mae = np.sum(np.where(scored, np.abs(observed - means), 0), axis = -1) / count
+    log_score = np.sum(np.where(scored, stats.nbinom.logpmf(observed, n, p), 0), axis = -1) / count
+    return coverage, mae, log_score
+
+def project_incidence(incidence, w, window, horizon = 14, n_paths = 5000, quantiles = (0.025, 0.5, 0.975), a = 1, b = 5, rng = None):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s. Leading
+    axes, e.g. regions, are projected together.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param window: the size of the window
+    :param horizon: the number of days after the last reported day to project.
+    :param n_paths: the number of sampled paths.
+    :param quantiles: the quantiles of the projected cases to return.
+    :param a, b: constants to be used in gamma distribution of a.
+    :param rng: a numpy.random.Generator, a new unseeded one is used by default.
+    :return: means, of shape (..., horizon), the mean projected cases on the days T, ..., T + horizon - 1. intervals, of
+    shape (len(quantiles), ..., horizon).
+
+    Every path draws its own R_t from the posterior of the last day and keeps it over the horizon. All the paths then
+    move forward together, one poisson draw per day as in eq. 1. The part of lambda coming from the reported days is
+    computed once for the whole horizon by convolution.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    incidence = np.asarray(incidence, dtype = float)
+    T = incidence.shape[-1]
+    lambdas = lambda_series(incidence, w)
+    alpha, beta = posterior_R_t_parameters(incidence, w, window, a = a, b = b, lambdas = lambdas)
+    alpha, beta = np.broadcast_arrays(alpha[..., T], beta[..., T])
+    r_t = rng.gamma(alpha[..., np.newaxis], 1 / beta[..., np.newaxis], size = alpha.shape + (n_paths,))
+
+    padding = [(0, 0)] * (incidence.ndim - 1) + [(0, horizon)]
+    reported_lambdas = lambda_series(np.pad(incidence, padding), w)[..., T:T + horizon] #zeros stand for projected days
+    kernel = kernel_array(w, horizon)
+
+    paths = np.zeros(r_t.shape + (horizon,))
+    for j in range(horizon):
+        lambdas_j = reported_lambdas[..., j:j + 1] + paths[..., :j] @ kernel[..., j:0:-1] #w(j), ..., w(1) against days T, ..., T + j - 1
+        paths[..., j] = rng.poisson(r_t * lambdas_j)
+
+    means = np.mean(paths, axis = -2)
+    intervals = np.quantile(paths, quantiles, axis = -2)
+    return means, intervals
+
+def select_window(incidence, w, windows, starts = 0, start_day = 0, a = 1, b = 5, lambdas = None):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param windows: the candidate window sizes.
+    :param starts: the first day of the series, a number or an array broadcast against the leading axes of incidence.
+    :param start_day: the first day after the start of every series to score.
+    :param a, b: constants to be used in gamma distribution of a.
+    :param lambdas: optional output of lambda_series(incidence, w).
+    :return: best, an ndarray of the leading shape of incidence with the window of the largest score, and scores, of
+    shape (len(windows),) + that shape, the sum of the one day ahead log likelihoods of every window.
+
+    The accumulated predictive error of Parag and Donnelly: every window predicts each day from the days before it
+    with the negative binomial of its posterior, and the window whose predictions scored best is selected. All the windows are
+    computed in one pass, from a single pair of cumulative sums of the incidence and of lambda, by broadcasting the
+    window starts along a leading axis. Every window scores the same days, from start_day or the largest window on,
+    so the sums can be compared. Days with negative counts are skipped. As in stats.nbinom.logpmf, cases on a day
+    without infectiousness (lambda_t = 0) have probability 0, their log likelihood is -inf for every window.
+    """
+    incidence = np.asarray(incidence, dtype = float)
+    if lambdas is None:
+        lambdas = lambda_series(incidence, w)
+    T = incidence.shape[-1]
+    windows = np.asarray(windows)
+    lambdas = lambdas[..., :T]
+
+    zeros = np.zeros(incidence.shape[:-1] + (1,))
+    cumulative_incidence = np.concatenate((zeros, np.cumsum(incidence, axis = -1)), axis = -1)
+    zeros = np.zeros(lambdas.shape[:-1] + (1,))
+    cumulative_lambdas = np.concatenate((zeros, np.cumsum(lambdas, axis = -1)), axis = -1)
+
+    t = np.arange(T)
+    window_start = np.maximum(t - windows.reshape((-1,) + (1,) * incidence.ndim), 0) #(windows, 1, ..., T)
+    alpha = a + cumulative_incidence[..., t] - np.take_along_axis(cumulative_incidence[np.newaxis], window_start, axis = -1)
+    beta = (1/b) + cumulative_lambdas[..., t] - np.take_along_axis(cumulative_lambdas[np.newaxis], window_start, axis = -1)
+
+    #negative binomial(alpha, beta / (beta + lambda)) log probability, the factorial of the cases is shared by every window
+    cases = np.maximum(incidence, 0)
+    log_likelihood = (special.gammaln(cases + alpha) - special.gammaln(alpha) + alpha * np.log(beta / (beta + lambdas))
+                      + special.xlogy(cases, lambdas / (beta + lambdas)))
+    log_likelihood -= special.gammaln(cases + 1)
+
+    starts = np.asarray(starts)[..., np.newaxis]
+    scored = (t >= starts + max(start_day, int(windows.max()))) & (incidence >= 0)
+    scores = np.sum(np.where(scored, log_likelihood, 0), axis = -1)
+    return windows[np.argmax(scores, axis = 0)], scores
+
+def infection_profile_kernel(mean, std_deviation, K):
+    """
+    :param mean: mean of the gamma distribution that the infection profile follows, a float or an array.
+    :param std_deviation: std_deviation of the gamma distribution that the infection profile follows, a float or an array.
+    :param K: the last day of the infection profile to compute.
+    :return: an ndarray of shape broadcast(mean, std_deviation).shape + (K + 1,) where kernel[..., s] is the descritized
+    probability of the infection profile at day s.
+
+    Following shifted gamma distribution on appendix 11. All the gamma cdfs needed for days 0 to K, and for every pair
+    of mean and std_deviation, are evaluated in a single call instead of six scalar calls per day.
+    """
+
+    mean = np.asarray(mean, dtype = float)[..., np.newaxis]
+    std_deviation = np.asarray(std_deviation, dtype = float)[..., np.newaxis]
+    beta = mean / (std_deviation ** 2) #since, mean = alpha/beta and variance = alpha/(beta^2)
+    alpha = mean * beta
+    alpha, beta = np.broadcast_arrays(alpha, beta)
+
+    s = np.arange(K + 1) + 1 #the closure shifts s by one day
+    points = np.arange(-1, K + 2) #covers s - 2, s - 1 and s for every day
+    cdfs = stats.gamma.cdf(points, a = np.stack((alpha, alpha + 1)), scale = 1/beta)
+    cdf, cdf_shape_plus_one = cdfs[0], cdfs[1]
+
+    kernel = (s * cdf[..., 2:]) + ((s - 2) * cdf[..., :-2]) - (2 * (s - 1) * cdf[..., 1:-1]) + \
+             ((alpha * 1/beta) * (2 * cdf_shape_plus_one[..., 1:-1] - cdf_shape_plus_one[..., :-2] - cdf_shape_plus_one[..., 2:]))
+    return kernel
+
+def truncated_infection_profile_kernel(mean, std_deviation, tolerance = KERNEL_TOLERANCE):
+    """
+    :param mean: mean of the gamma distribution that the infection profile follows, a float or an array.
+    :param std_deviation: std_deviation of the gamma distribution that the infection profile follows, a float or an array.
+    :param tolerance: the largest mass of the tail of the infection profile to discard.
+    :return: kernel, discarded. kernel is the output of infection_profile_kernel up to the first day K after which at
+    most tolerance of the mass is left, K is shared by every pair of mean and std_deviation. discarded is the mass
+    after day K of every pair.
+
+    The kernel is doubled in length until every tail is below tolerance, or until 2**16 days. A pair whose tail is
+    still above tolerance then keeps every day computed, and discarded holds its tail, larger than tolerance. Round
+    off below zero in the tail is removed.
+    """
+    K = 64
+    while True:
+        kernel = infection_profile_kernel(mean, std_deviation, K)
+        tail = 1 - np.cumsum(kernel, axis = -1) #tail[..., k] is the mass after day k
+        below = tail <= tolerance
+        if np.all(below[..., -1]) or K >= 2**16:
+            break
+        K *= 2
+
+    K = int(np.max(np.where(np.any(below, axis = -1), np.argmax(below, axis = -1), K)))
+    return np.maximum(kernel[..., :K + 1], 0), np.maximum(tail[..., K], 0)
+
+
 def infection_profile(mean, std_deviation):
     """
     :param mean: mean of the gamma distribution that the infection profile follows.
@@ -109,26 +474,20 @@ def infection_profile(mean, std_deviation):
     :param s: day at which to determine probability.
     :return: descritized probability of the infection profile at day s.
 
-    Following shifted gamma distribution on appendix 11
+    Following shifted gamma distribution on appendix 11. Thin wrapper around infection_profile_kernel, the kernel is
+    doubled in length whenever a day past its end is requested.
     """
 
-    beta = mean / (std_deviation ** 2) #since, mean = alpha/beta and variance = alpha/(beta^2)
-    alpha = mean * beta
-
-    probs = {}
+    kernel = infection_profile_kernel(mean, std_deviation, 64)
     def prob(s):
+        nonlocal kernel
         int_s = int(s)
         assert np.allclose([int_s], [s])  # making sure s is an integer
-        s += 1
-        if s in probs:
-            return probs[s]
-        else:
-            prob = (np.convolve(s,stats.gamma.cdf(s, a = alpha, scale = 1/beta))) + (np.convolve((s - 2), stats.gamma.cdf(s - 2, a = alpha, scale = 1/beta)) ) - \
-                   (np.convolve(2,  np.convolve((s - 1) , stats.gamma.cdf(s - 1, a = alpha, scale = 1/beta)))) + \
-                   ((alpha * 1/beta)*(2*(stats.gamma.cdf(s-1, a = alpha + 1, scale = 1/beta))- stats.gamma.cdf(s - 2, a = alpha + 1, scale = 1/beta) - \
-                                      stats.gamma.cdf(s, a = alpha + 1, scale = 1/beta)))
-        probs[s] = prob[0]
-        return prob[0]
+        if int_s < 0:
+            return 0.0
+        if int_s >= len(kernel):
+            kernel = infection_profile_kernel(mean, std_deviation, 2 * int_s)
+        return kernel[int_s]
     return prob
 
 
@@ -137,10 +496,30 @@ def truncated_normal(mean, sd, lower, upper, n = 1):
     return stats.truncnorm.rvs(a,b, loc = mean, scale = sd, size = n)
 
 
+def sample_serial_intervals(mean_si, sd_si, n):
+    """
+    :param mean_si: Mean of the serial interval
+    :param sd_si: standard deviation of serial interval
+    :param n: number of pairs to draw
+    :return: two arrays of length n, the means and the standard deviations of the sampled serial intervals.
+
+    Means follow a normal truncated to [3.7, 6.0] and SDs a normal truncated to [1.9, 4.9]. Any SD not smaller than its
+    mean is redrawn, all rejected SDs are redrawn together in one call.
+    """
+    means = truncated_normal(mean_si, lower= 3.7, upper= 6.0, sd = 1, n = n)
+    sd = truncated_normal(sd_si, lower=1.9, upper= 4.9, sd = 1, n = n)
+    rejected = sd >= means
+    while np.any(rejected):
+        sd[rejected] = truncated_normal(sd_si, lower=1.9, upper= 4.9, sd = 1, n = np.count_nonzero(rejected))
+        rejected = sd >= means
+    return means, sd
+
+
 def mean_confidence_interval(data, confidence=0.95):
+    """Mean and confidence interval of data along its first axis."""
     a = 1.0 * np.array(data)
-    n = len(a)
-    m, se = np.mean(a), stats.sem(a)
+    n = a.shape[0]
+    m, se = np.mean(a, axis = 0), stats.sem(a, axis = 0)
     h = se * stats.t.ppf((1 + confidence) / 2., n-1)
     return m, m-h, m+h
 
@@ -162,21 +541,41 @@ def read_file(file_name):
         incidence_data.append(int(line_split[1]))
     return days, incidence_data
 
-def plot_serial_interval(t, probability, label = ''):
+def read_series(data_file):
+    """
+    :param data_file: a txt file, or the name of a region in the incidence store.
+    :return: two arrays denoting days and no_of_cases (I_t)
+    """
+    if data_file.endswith(".txt"):
+        return read_file(data_file)
+    return incidence_store.read_region(data_file)
+
+def _current_axes():
+    import matplotlib.pyplot as plt #imported on the first plot, so computing estimates never loads matplotlib
+    return plt.gca()
+
+
+def plot_serial_interval(t, probability, label = '', plot_surface = None):
+    if plot_surface is None:
+        plot_surface = _current_axes()
     t = list(t)
     plot_surface.bar(t, probability, width=0.4, label=label)
     plot_surface.set_xlabel("Days T")
     plot_surface.set_ylabel("Probability of w(t)")
 
 
-def plot_incidence_data(t, data, label = ''):
+def plot_incidence_data(t, data, label = '', plot_surface = None):
+    if plot_surface is None:
+        plot_surface = _current_axes()
     plot_surface.bar(list(t), data, label=label)
     plot_surface.set_xlabel("Days T")
     plot_surface.set_ylabel("Incidence per day")
     plot_surface.grid()
 
-def plot_estimates_r_t(t, starts, ends, means, label = ''):
+def plot_estimates_r_t(t, starts, ends, means, label = '', plot_surface = None):
     assert len(t) == len(starts) == len(ends) == len(means)
+    if plot_surface is None:
+        plot_surface = _current_axes()
     plot_surface.fill_between(list(t), starts, ends, alpha=0.1, color="black")
 
     # print(estimates_of_R_t.index(max(estimates_of_R_t[day:])))
@@ -185,166 +584,479 @@ def plot_estimates_r_t(t, starts, ends, means, label = ''):
     plot_surface.set_ylabel("Effective reproduction number - Rt")
 
 
-def plot_incidence_with_prediction(T, incidence_data, window, plot_surface, w, number_of_days_to_exclude = 6):
-    train_data = incidence_data[:41]  # excluding last 6 days from train data
-    test_data = incidence_data[41:]
-    predicted = []
-    estimates_of_R_t = []
-    current_day = 0
-
-    for t in range(len(train_data)):
-        estimates_of_R_t.append(
-            estimate_R_t(current_day, window, incidence_data=train_data, w=w))  # estimating R_t for reported cases
-        current_day += 1
-
-    plot_surface.scatter(range(1, len(train_data) + 1), train_data, zorder=10, label="Reported cases", c='b')
-    plot_surface.scatter(range(len(train_data), len(train_data) + len(test_data) + 1),
-                         [train_data[-1]] + test_data, zorder=5, c='b')
-
-    for t in range(len(test_data)):
-        estimates_of_R_t.append(estimate_R_t(current_day, window, incidence_data=train_data,
-                                             w=w))  # getting r_t for next prediction
-        predicted.append(predict_I_t(current_day, estimates_of_R_t[-1][-1], incidence_data=train_data,
-                                     w=w))  # getting our prediction using last value of R_t
-        train_data.append(test_data[t])  # adding actual value to train data
-        current_day += 1
-
-    estimates_of_R_t.append(estimate_R_t(current_day, window, incidence_data=train_data,
-                                         w=w))
-    predicted.append(predict_I_t(current_day, estimates_of_R_t[-1][-1], incidence_data=train_data,
-                                 w=w))  # getting our prediction using last value of R_t
-
-    train_data.append(predicted[-1][-1])
-    plot_surface.set_xlim(0, T + 2)
+def predict_last_days(incidence_data, w, window, number_of_days_to_exclude = 6, lambdas = None, series_starts = None):
+    """
+    :param incidence_data: a list of integers. indcidence_data[s] represents the number of incident cases on day s.
+    Also an array of shape (regions, days), every row is then predicted at once.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param window: the size of the window
+    :param number_of_days_to_exclude: the number of last reported days to predict.
+    :param lambdas: optional output of lambda_series(incidence_data, w).
+    :param series_starts: optional first day of the series of every row, predictions before its first full window are nan.
+    :return: days, means, starts, ends. The one day ahead prediction of the last number_of_days_to_exclude days and of
+    the day after the last reported day, with its 95% poisson interval. days counts from 1 like the days of read_file.
+    means, starts and ends have the leading axes of incidence_data. Every prediction uses R_t estimated from the days
+    before it.
+    """
+    incidence_data = np.asarray(incidence_data)
+    train_days = incidence_data.shape[-1] - number_of_days_to_exclude  # excluding last days from train data
+    if lambdas is None:
+        lambdas = lambda_series(incidence_data, w)
+    alpha, beta = posterior_R_t_parameters(incidence_data, w, window, lambdas = lambdas)
+
+    predicted_days = np.arange(train_days, incidence_data.shape[-1] + 1)
+    means = (alpha / beta)[..., predicted_days] * lambdas[..., predicted_days] # prediction using the last value of R_t
+    if series_starts is not None:
+        means = np.where(before_first_window(lambdas.shape[-1], series_starts, window)[..., predicted_days], np.nan, means)
+    starts, ends = stats.poisson.interval(0.95, means)
+    return predicted_days + 1, means, starts, ends
+
 
-    starts, ends, means = [], [], []  # start of confidence interval, end of interval, mean of prediction
+def draw_prediction(T, incidence_data, prediction, plot_surface, label = "Reported cases"):
+    """
+    :param T: the last day.
+    :param incidence_data: the reported cases, or the nowcast onsets.
+    :param prediction: the output of predict_last_days.
+    :param plot_surface: the surface at which to produce plots
+    :param label: the legend of incidence_data.
+    """
+    days, means, starts, ends = prediction
+    train_days = days[0] - 1
+    plot_surface.scatter(range(1, train_days + 1), incidence_data[:train_days], zorder=10, label=label, c='b')
+    plot_surface.scatter(range(train_days, len(incidence_data) + 1), incidence_data[train_days - 1:], zorder=5, c='b')
+    plot_surface.set_xlim(0, T + 2)
 
-    for t in range(len(predicted)):
-        means.append(predicted[t][-1])
-        starts.append(predicted[t][0][0])
-        ends.append(predicted[t][0][1])
-    plot_surface.fill_between(range(len(train_data) - len(predicted) + 1, len(train_data) + 1), starts, ends, alpha=0.1,
+    plot_surface.fill_between(days, starts, ends, alpha=0.1,
                               color="black", zorder=10, label = "confidence interval of prediction")
-    plot_surface.plot(range(len(train_data) - len(predicted) + 1, len(train_data) + 1), means, 'r', zorder=15,
+    plot_surface.plot(days, means, zorder=15,
                       color="black", label="mean of prediction")
     plot_surface.set_xlabel("Days T")
     plot_surface.set_ylabel("No of New cases")
 
-def model_epidemic(data_file, mean_si, sd_si, window = 1, plot_start_day = 7,  uncertain_w = False,  plot_w = False, plot_incidence = False, plot_r_t = False, plot_surface = None, label = '', with_prediction = False):
+
+def plot_incidence_with_prediction(T, incidence_data, window, plot_surface, w, number_of_days_to_exclude = 6):
+    """
+    Plots the reported cases with the one day ahead prediction of the last number_of_days_to_exclude days and of the
+    day after the last reported day. Every prediction uses R_t estimated from the days before it.
+    """
+    incidence_data = np.asarray(incidence_data)
+    with profiling.stage("prediction.estimate"):
+        prediction = predict_last_days(incidence_data, w, window, number_of_days_to_exclude)
+    with profiling.stage("prediction.draw"):
+        draw_prediction(T, incidence_data, prediction, plot_surface)
+
+
+EpidemicEstimates = namedtuple("EpidemicEstimates", [
+    "days", #days of the series, counting from 1
+    "incidence", #reported cases of every day
+    "serial_interval", #w(s) for the days the kernel covers, from s = 0
+    "mean_si", "sd_si", #the serial interval of serial_interval, the mean of the samples when uncertain_w is True
+    "r_t_days", "r_t_means", "r_t_starts", "r_t_ends", #R_t with its 95% interval from plot_start_day on
+    "prediction", #the output of predict_last_days
+])
+
+
+def estimate_epidemic(data_file, mean_si, sd_si, window = 1, plot_start_day = 7, uncertain_w = False, n_si_samples = 1000, w = None, number_of_days_to_exclude = 6):
+    """
+    :param data_file: the file containing data of the epidemic to be modelled, or the name of a region in the incidence store.
+    :param mean_si: Mean of the serial interval
+    :param sd_si: standard deviation of serial interval
+    :param window: the window size at which to estimate R_t
+    :param plot_start_day: the day which to start estimating R_t
+    :param uncertain_w: If True, n_si_samples infectious profiles are constructed to estimate R_t
+    :param n_si_samples: number of (mean, SD) pairs of the serial interval sampled when uncertain_w is True
+    :param w: optional infectious profile (an ndarray kernel or a function w(t)) used instead of building one from mean_si and sd_si
+    :param number_of_days_to_exclude: the number of last reported days to predict.
+    :return: an EpidemicEstimates with everything model_epidemic draws, computed once and without matplotlib.
+    """
+    with profiling.stage("estimate.read_series"):
+        days, incidence_data = read_series(data_file)
+        incidence_data = np.asarray(incidence_data)
+    with profiling.stage("estimate.kernel"):
+        if w is None:
+            w, discarded = truncated_infection_profile_kernel(mean_si, sd_si)
+        T = days[-1] #last day
+        lambdas = lambda_series(incidence_data, w)
+
+    with profiling.stage("estimate.prediction"):
+        prediction = predict_last_days(incidence_data, w, window, number_of_days_to_exclude, lambdas = lambdas)
+
+    with profiling.stage("estimate.r_t"):
+        if not uncertain_w:
+            serial_interval = w if not callable(w) else kernel_array(w, T - 1)
+            means, (starts, ends) = estimate_R_t_series(incidence_data, w, window, lambdas = lambdas)
+            r_t_days = np.arange(plot_start_day, T + 1)
+            means, starts, ends = means[plot_start_day:], starts[plot_start_day:], ends[plot_start_day:]
+        else:
+            #generating N pairs of mean and SD for gamma distribution paramters for SI.
+            si_means, si_sds = sample_serial_intervals(mean_si, sd_si, n_si_samples)
+            mean_si = round(np.mean(si_means), 2)
+            sd_si = round(np.mean(si_sds), 2)
+            serial_interval, discarded = truncated_infection_profile_kernel(mean_si, sd_si)
+
+            kernels, discarded = truncated_infection_profile_kernel(si_means, si_sds) #one row per sampled serial interval
+            si_lambdas = lambda_series(incidence_data, kernels)
+            alpha, beta = posterior_R_t_parameters(incidence_data, kernels, window, lambdas = si_lambdas)
+            estimates_of_r_t = np.random.gamma(alpha[:T], 1 / beta[:, :T]) #one posterior draw per profile and day
+
+            r_t_days = np.arange(plot_start_day, T)
+            means, starts, ends = mean_confidence_interval(estimates_of_r_t[:, plot_start_day:T])
+
+    return EpidemicEstimates(days, incidence_data, serial_interval, mean_si, sd_si, r_t_days, means, starts, ends, prediction)
+
+
+def estimate_regions(names, mean_si, sd_si, window = 1, plot_start_day = 7, w = None, number_of_days_to_exclude = 6, store_name = incidence_store.STORE_NAME):
+    """
+    :param names: the names of regions in the incidence store.
+    :param mean_si: Mean of the serial interval
+    :param sd_si: standard deviation of serial interval
+    :param window: the window size at which to estimate R_t
+    :param plot_start_day: the day which to start estimating R_t
+    :param w: optional infectious profile (an ndarray kernel or a function w(t)) used instead of building one from mean_si and sd_si
+    :param number_of_days_to_exclude: the number of last reported days to predict.
+    :param store_name: path of the store without extension, or a list with the store of every name.
+    :return: a list with the EpidemicEstimates of every region, as estimate_epidemic returns for each of them.
+
+    Every region is estimated together on the (regions x days) matrix of incidence_store.load_regions, even when they
+    come from different stores: one lambda_series, one stats.gamma.ppf for R_t and one poisson interval for the
+    predictions. The days before the start of a series are zeros, so they add nothing to lambda or to the window sums,
+    and the days before its first full window are masked.
+    """
+    store_names = [store_name] * len(names) if isinstance(store_name, str) else store_name
+    incidence, starts = incidence_store.load_regions(names, store_names)
+    incidence = incidence.astype(float)
+    with profiling.stage("estimate_regions.kernel"):
+        if w is None:
+            w, discarded = truncated_infection_profile_kernel(mean_si, sd_si)
+        lambdas = lambda_series(incidence, w)
+    with profiling.stage("estimate_regions.r_t"):
+        r_t_means, (r_t_starts, r_t_ends) = estimate_R_t_series(incidence, w, window, lambdas = lambdas, starts = starts)
+    with profiling.stage("estimate_regions.prediction"):
+        days, means, prediction_starts, prediction_ends = predict_last_days(incidence, w, window, number_of_days_to_exclude,
+                                                                            lambdas = lambdas, series_starts = starts)
+
+    serial_interval = w if not callable(w) else kernel_array(w, incidence.shape[-1] - starts.min() - 1)
+    estimates = []
+    for i in range(len(names)):
+        first = starts[i] + plot_start_day
+        series = incidence[i, starts[i]:].astype(np.int64)
+        prediction = (days - starts[i], means[i], prediction_starts[i], prediction_ends[i])
+        estimates.append(EpidemicEstimates(list(range(1, len(series) + 1)), series, serial_interval, mean_si, sd_si,
+                                           np.arange(plot_start_day, len(series) + 1), r_t_means[i, first:],
+                                           r_t_starts[i, first:], r_t_ends[i, first:], prediction))
+    return estimates
+
+
+def draw_r_t(estimates, plot_surface, label = ''):
+    """Draws R_t of an EpidemicEstimates with its interval."""
+    plot_estimates_r_t(estimates.r_t_days, starts = estimates.r_t_starts, ends = estimates.r_t_ends,
+                       means = estimates.r_t_means, label = label, plot_surface = plot_surface)
+    plot_surface.set_xlim(0, estimates.days[-1] + 2)
+
+
+def model_epidemic(data_file, mean_si, sd_si, window = 1, plot_start_day = 7,  uncertain_w = False,  plot_w = False, plot_incidence = False, plot_r_t = False, plot_surface = None, label = '', with_prediction = False, n_si_samples = 1000, w = None):
     '''
-    :param data_file: the file containing data of the epidemic to be modelled.
+    :param data_file: the file containing data of the epidemic to be modelled, or the name of a region in the incidence store.
     :param mean_si: Mean of the serial interval
     :param sd_si: standard deviation of serial interval
     :param window: the window size at which to estimate R_t
     :param plot_start_day: the day which to start estimating R_t
-    :param uncertain_w: If True, 1000 infectious profiles are constructed to estimate R_t
+    :param uncertain_w: If True, n_si_samples infectious profiles are constructed to estimate R_t
     :param plot_w: whether to plot infectious profile
     :param plot_incidence: whether or not to plot incidence data
     :param plot_r_t: whether or not to plot estimates of R_t
     :param plot_surface: the surface at which to produce plots
     :param label: label of the plots
     :param with_prediction: whether to plot incidence data with prediction of last 6 days
-    :return: None
+    :param n_si_samples: number of (mean, SD) pairs of the serial interval sampled when uncertain_w is True
+    :param w: optional infectious profile (an ndarray kernel or a function w(t)) used instead of building one from mean_si and sd_si
+    :return: the EpidemicEstimates that were drawn
     ***ONLY one of plot_rt, plot_incidence, plot_w can be true. plot incidence must be true, incase with_pridiction is true.
+    Draws from estimate_epidemic, use it directly to draw several plots of a region from a single computation.
     '''
-    days, incidence_data = read_file(data_file)
-    #incidence_data = [np.random.negative_binomial(i, 0.2) + i - 1 for i in incidence_data]
-    w = infection_profile(mean_si, sd_si)
-    T = days[-1] #last day
-    serial_interval_prob = []
-    for t in range(T):
-        serial_interval_prob.append(w(t))
-
-    if plot_incidence:
-        if not with_prediction:
-            plot_incidence_data(range(T), incidence_data, label=label)
-            return
+    estimates = estimate_epidemic(data_file, mean_si, sd_si, window = window, plot_start_day = plot_start_day,
+                                  uncertain_w = uncertain_w, n_si_samples = n_si_samples, w = w)
+    T = estimates.days[-1]
+
+    with profiling.stage("model_epidemic.draw"):
+        if plot_incidence:
+            if not with_prediction:
+                plot_incidence_data(range(T), estimates.incidence, label=label, plot_surface=plot_surface)
+            else:
+                if plot_surface is None:
+                    plot_surface = _current_axes()
+                draw_prediction(T, estimates.incidence, estimates.prediction, plot_surface)
+        elif plot_w:
+            plot_serial_interval(range(1, len(estimates.serial_interval) + 1), estimates.serial_interval, label = "mean = " + str(estimates.mean_si) + " SD = " + str(estimates.sd_si), plot_surface = plot_surface)
+        elif plot_r_t:
+            if plot_surface is None:
+                plot_surface = _current_axes()
+            draw_r_t(estimates, plot_surface, label = label)
+    return estimates
+
+
+def extract_dates_from_txt(txt_file):
+    file = open(txt_file, "r")
+    first_line = file.readline().strip()
+    start_date, end_date = first_line.split(",")
+    file.close()
+    return start_date, end_date
+
+
+def extract_dates(data_file, store_name = incidence_store.STORE_NAME):
+    if data_file.endswith(".txt"):
+        return extract_dates_from_txt(data_file)
+    return incidence_store.region_dates(data_file, store_name)
+
+
+def set_date_ticks(plot_surface):
+    start_date = datetime.date(2020, 2, 28) #
+    delta = datetime.timedelta(days=10)
+    dates = []
+    for i in range(51):
+        dates.append(start_date)
+        start_date += delta
+    dates = [i.strftime("%d-%b") for i in dates] #aligning dates on xaxis
+    plot_surface.set_xticklabels(dates[1:])
+
+
+def plot_region(name, window, mean_si, sd_si, w = None, plot_start_day = 20, formats = ("png",), output_dir = "Predictions", estimates = None, store_name = incidence_store.STORE_NAME):
+    """
+    :param name: the txt file of the region to plot, or the name of a region in the incidence store.
+    :param window: the window size at which to estimate R_t
+    :param mean_si: Mean of the serial interval
+    :param sd_si: standard deviation of serial interval
+    :param w: optional infectious profile shared between regions
+    :param plot_start_day: the day which to start estimating R_t
+    :param formats: file formats to save the figure in, pdf files get the end date in their name.
+    :param output_dir: the directory to save the figures in.
+    :param estimates: optional EpidemicEstimates of the region, e.g. from estimate_regions, computed here by default.
+    :param store_name: the store the dates of a region of the store are read from.
+    :return: None
+
+    Draws the R_t estimates on top and the incidence with prediction of the last 6 days below, then saves the figure.
+    Both plots are drawn from a single estimate_epidemic. For a region of the nowcast store, the incidence and its
+    predictions are the nowcast onsets, which end before the reports, so the reports are drawn next to them and the
+    title gives both last dates.
+    """
+    import matplotlib.pyplot as plt
+
+    if estimates is None:
+        estimates = estimate_epidemic(name, mean_si, sd_si, window = window, plot_start_day = plot_start_day, w = w)
+    T = estimates.days[-1]
+    fig, axs = plt.subplots(2, 1)
+    from_date, end_date = extract_dates(name, store_name)
+    region = os.path.splitext(name)[0]
+    nowcast = store_name == nowcasting.NOWCAST_STORE_NAME
+    #plot for R_t estimates
+    plot_surface = axs[1]
+    with profiling.stage("plot_region.draw"):
+        draw_prediction(T, estimates.incidence, estimates.prediction, plot_surface, label = "Nowcast onsets" if nowcast else "Reported cases")
+        if nowcast: #the reports the onsets are nowcast from, with the last days left out of the nowcast store
+            days, reports = incidence_store.read_region(region)
+            plot_surface.scatter(days, reports, zorder=5, label="Reported cases", c='grey', marker='x')
+            plot_surface.set_xlim(0, len(days) + 2)
+    set_date_ticks(plot_surface)
+
+    plot_surface.legend()
+    plot_surface.grid()
+    #plot_surface.set_ylim((0, 5))
+
+    plot_surface = axs[0]
+    plot_surface.axhline(1, ls='--', label='1')
+    with profiling.stage("plot_region.draw"):
+        draw_r_t(estimates, plot_surface)
+    plot_surface.legend()
+    if nowcast:
+        plot_surface.set_title(f"{region} nowcast onsets with window size = {window} starting from {from_date} to {end_date}, "
+                               f"reported to {incidence_store.region_dates(region)[1]}")
+    else:
+        plot_surface.set_title(f"{region} Data with window size = {window} starting from {from_date} to {end_date}")
+    set_date_ticks(plot_surface)
+    plot_surface.legend()
+    plot_surface.grid()
+
+    #plt.tight_layout()
+    fig.set_size_inches(16, 9)
+    for extension in formats:
+        if extension == "pdf":
+            file_name = f"{region}_{end_date}.pdf"
         else:
-            plot_incidence_with_prediction(T = T, incidence_data = incidence_data, window = window, plot_surface = plot_surface, w = w, number_of_days_to_exclude= 6)
+            file_name = f"{region}.{extension}"
+        with profiling.stage("plot_region.savefig"):
+            fig.savefig(os.path.join(output_dir, file_name), bbox_inches  = 'tight', dpi = 100)
+    plt.close(fig)
 
 
-    if not uncertain_w:
-        if plot_w:
-            plot_serial_interval(range(1, T + 1), serial_interval_prob, label = "mean = " + str(mean_si) + " SD = " + str(sd_si))
+def _init_worker(profile = False):
+    import matplotlib
+    matplotlib.use("Agg")
+    profiling.enable(profile)
 
-        elif plot_r_t:
-            T += 1
-            estimates_of_R_t = []
-            for t in range(T):
-                estimates_of_R_t.append(estimate_R_t(t, window, incidence_data=incidence_data, w=w))
-            means, start, end = [], [], []
-            for i in range(T):
-                m = estimates_of_R_t[i][-1]
-                means.append(m)
-                start.append(estimates_of_R_t[i][0][0])
-                end.append(estimates_of_R_t[i][0][1])
-
-            plot_estimates_r_t(range(plot_start_day, T), starts=start[plot_start_day:], ends=end[plot_start_day:], means=means[plot_start_day:], label=label)
-            plot_surface.set_xlim(0, T+ 1)
-        return
-
-    if uncertain_w:
-        #generating 1000 pairs of mean and SD for gamma distribution paramters for SI.
-        serial_interval_prob = []
-        N = 1000
-        means = truncated_normal(mean_si, lower= 3.7, upper= 6.0, sd = 1, n = N)
-        sd = [max(means) + 1 for i in range(N)]
-        for i in range(N):
-            while sd[i] >= means[i]:
-
-                sd[i] = truncated_normal(sd_si, lower=1.9, upper= 4.9, sd = 1)
-        mean_of_means = round(np.mean(means), 2)
-        mean_of_SD = round(np.mean(sd), 2)
-
-        w = infection_profile(mean_of_means, mean_of_SD)
-
-        if plot_w:
-            for t in range(T):
-                serial_interval_prob.append(w(t))
-            plot_serial_interval(range(1, T + 1), serial_interval_prob, label = "mean = " + str(mean_of_means) + " SD = " + str(mean_of_SD))
 
-        elif plot_r_t:
-            estimates_of_r_t = np.zeros((N, T))
-            for n in range(N):
-                print(n)
-                w = infection_profile(means[n], sd[n])
-                for t in range(T):
-                    estimates_of_r_t[n, t] = estimate_R_t(t = t, pi = window, incidence_data = incidence_data, w = w, sample=True, n = 1)[0]
+def _plot_region_safely(name, *args, **kwargs):
+    """
+    Runs plot_region and returns (name, seconds taken, traceback or None, profile) instead of raising. profile is
+    the profiling record of the region, None unless profiling is enabled.
+    """
+    start = time.perf_counter()
+    with profiling.region(name), profiling.stage("region"):
+        try:
+            plot_region(name, *args, **kwargs)
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+    return name, time.perf_counter() - start, error, profiling.pop(name)
 
-            starts_of_r_t, ends_of_r_t, means_of_r_t = [],[],[]
-            for t in range(plot_start_day, T):
-                data = estimates_of_r_t[:, t]
-                mean, start, end = mean_confidence_interval(data)
-                starts_of_r_t.append(start)
-                ends_of_r_t.append(end)
-                means_of_r_t.append(mean)
 
-            plot_estimates_r_t(range(plot_start_day, T), starts=starts_of_r_t, ends=ends_of_r_t,
-                               means= means_of_r_t, label=label)
-        return
+def run_regions(names, window, mean_si, sd_si, workers = None, plot_start_day = 20, formats = ("png",), output_dir = "Predictions", store_name = incidence_store.STORE_NAME):
+    """
+    :param names: the txt files of the regions to plot, or the names of regions in the incidence store.
+    :param window: the window size at which to estimate R_t
+    :param mean_si: Mean of the serial interval
+    :param sd_si: standard deviation of serial interval
+    :param workers: number of worker processes, None uses every core and 1 runs in this process.
+    :param plot_start_day: the day which to start estimating R_t
+    :param formats: file formats to save every figure in.
+    :param output_dir: the directory to save the figures in.
+    :param store_name: the store of the regions that are not txt files, e.g. nowcasting.NOWCAST_STORE_NAME, or a list
+    with the store of every name.
+    :return: a list of (name, seconds, error) for every region, error is None unless the region failed.
+
+    The serial interval kernel is built once and shared by every region. The regions of every store are all estimated
+    together by a single estimate_regions and their workers only draw. Regions are spread over a process pool whose workers
+    draw on the headless Agg backend. A failing region is reported and the others still run. When profiling is
+    enabled, the stage timings of every region are collected back into this process.
+    """
+    with profiling.stage("run_regions.kernel"):
+        w, discarded = truncated_infection_profile_kernel(mean_si, sd_si)
+    print(f"Serial interval kernel of {len(w) - 1} days, discarding a tail of {discarded:.1e}")
+    args = (window, mean_si, sd_si, w, plot_start_day, formats, output_dir)
+
+    stores = [store_name] * len(names) if isinstance(store_name, str) else store_name
+    estimates = [None] * len(names) #txt files are estimated by their worker
+    in_stores = [i for i in range(len(names)) if not names[i].endswith(".txt")]
+    if in_stores:
+        with profiling.stage("run_regions.estimate"):
+            batch = estimate_regions([names[i] for i in in_stores], mean_si, sd_si, window, plot_start_day, w, store_name = [stores[i] for i in in_stores])
+        for i, region_estimates in zip(in_stores, batch):
+            estimates[i] = region_estimates
+
+    results = []
+    if workers == 1:
+        for i, name in enumerate(names):
+            print(f"Starting {name}")
+            name, seconds, error, profile = _plot_region_safely(name, *args, estimates = estimates[i], store_name = stores[i])
+            profiling.merge(name, profile)
+            results.append((name, seconds, error))
+            print(f"Saved {name}" if error is None else f"Failed {name}")
+    else:
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (profiling.ENABLED,)) as executor:
+            futures = [executor.submit(_plot_region_safely, names[i], *args, estimates = estimates[i], store_name = stores[i]) for i in range(len(names))]
+            for future in futures:
+                name, seconds, error, profile = future.result()
+                profiling.merge(name, profile)
+                results.append((name, seconds, error))
+                print(f"Saved {name}" if error is None else f"Failed {name}")
+
+    for name, seconds, error in results:
+        print(f"{name}: {seconds:.2f}s")
+        if error is not None:
+            print(error)
+    return results
+
+
+def write_projections(file_name, regions, last_dates, means, intervals, quantiles):
+    """
+    :param file_name: the csv file to write.
+    :param regions: the names of the projected regions.
+    :param last_dates: the last reported date of every region.
+    :param means, intervals: outputs of project_incidence for the regions.
+    :param quantiles: the quantiles of intervals.
+    :return: None
 
+    The quantiles are written as whole cases rounded away from the median: down below it, up above it and to the
+    nearest at it, so the intervals are never narrower than the projected ones.
+    """
+    whole = [np.floor if q < 0.5 else np.ceil if q > 0.5 else np.round for q in quantiles]
+    with open(file_name, newline='', mode='w') as csvfile:
+        spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|')
+        spamwriter.writerow(["Region", "Last reported date", "Days ahead", "Mean"] + [f"Q{q}" for q in quantiles])
+        for i in range(len(regions)):
+            for j in range(means.shape[-1]):
+                spamwriter.writerow([regions[i], last_dates[i], j + 1, round(means[i, j], 1)] +
+                                    [int(whole[k](intervals[k, i, j])) for k in range(len(quantiles))])
 
 
-def extract_dates_from_txt(txt_file):
-    file = open(txt_file, "r")
-    first_line = file.readline().strip()
-    start_date, end_date = first_line.split(",")
-    file.close()
-    return start_date, end_date
+def write_calibration(file_name, regions, window, coverage, mae, log_score, level, discarded):
+    """
+    :param file_name: the csv file to write.
+    :param regions: the names of the backtested regions.
+    :param window: the window of the backtested forecasts.
+    :param coverage, mae, log_score: outputs of backtest_forecasts for the regions.
+    :param level: the level of the intervals of coverage.
+    :param discarded: the tail of the serial interval cut off the kernel of the forecasts.
+    :return: None
+    """
+    with open(file_name, newline='', mode='w') as csvfile:
+        spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|')
+        spamwriter.writerow(["Region", "Window", "Days ahead", f"Coverage {level}", "MAE", "Log score", "Discarded SI tail"])
+        for i in range(len(regions)):
+            for j in range(coverage.shape[-1]):
+                spamwriter.writerow([regions[i], window, j + 1, round(coverage[i, j], 3), round(mae[i, j], 1), round(log_score[i, j], 3), f"{discarded:.1e}"])
+
+
+def write_windows(file_name, regions, windows, best, scores, window):
+    """
+    :param file_name: the csv file to write.
+    :param regions: the names of the regions.
+    :param windows: the candidate windows.
+    :param best, scores: outputs of select_window for the regions.
+    :param window: the window of the published R_t, whose score is written next to the best one.
+    :return: None
+    """
+    windows = list(windows)
+    with open(file_name, newline='', mode='w') as csvfile:
+        spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|')
+        spamwriter.writerow(["Region", "Best window", "Best log score", "Window", "Log score"])
+        for i in range(len(regions)):
+            spamwriter.writerow([regions[i], best[i], round(np.max(scores[:, i]), 1), window, round(scores[windows.index(window), i], 1)])
 
 
 if __name__ == "__main__":
-    names = ["Punjab", "Sindh", "GB", "ICT", "KPK", "AJK", "Balochistan", "Pakistan", "United Kingdom", "Italy", "Spain", "China"]
-    names = [i + ".txt" for i in names]
+    names = ["Punjab", "Sindh", "GB", "ICT", "KPK", "AJK", "Balochistan", "Pakistan"] #regions of the incidence store
+    world_names = ["United Kingdom", "Italy", "Spain", "China"] #countries of the world store, from worldData.csv
 
-    select = [i for i in names] #write names of files to select.
+    select = [i for i in names + world_names] #write names of regions to select.
 
 
 
     WINDOW = 4
     MEAN_SERIAL_INTERVAL = 4 #8.4 #4
     STD_SERIAL_INTERVAL = 5 # 3.8 #5
+    #grid_search.py ranks every (window, mean, sd) by its one day ahead predictions in grid_search.csv, its best are not
+    #used here: for most regions they sit on the edge of the grid, at the largest mean serial interval, with windows of
+    #1 to 3 days, which smooth the batches of the reports rather than describe the transmission. The serial interval
+    #is a property of the virus, taken from contact tracing, and is shared by every region.
     CURRENT_DATE = datetime.date.today()
+    WORKERS = None #number of processes, None uses every core
+    PROJECTION_DAYS = 14
+    PROJECTION_QUANTILES = (0.025, 0.25, 0.5, 0.75, 0.975)
+    BACKTEST_DAYS = 7 #the forecasts of every day up to this many days ahead are scored against the reports
+    BACKTEST_LEVEL = 0.95
+    CANDIDATE_WINDOWS = range(1, 15) #the window of best one day ahead predictions of every region goes to windows.csv
+    #and is not used for R_t: the best windows range from 1 to 14 days between regions, move by days as days are added
+    #and are scored on the reported cases, not on the nowcast onsets R_t is estimated from. One fixed WINDOW keeps the
+    #R_t of every region and night comparable, windows.csv shows how much score it gives up.
+    FORMATS = ("png",) #add "pdf" to also save Predictions/<name>_<end date>.pdf
+    PROFILE = False #or set COVID_PROFILE=1, writes the stage timings of every region to PROFILE_FILE
+    PROFILE_FILE = profiling.PROFILE_FILE
+    NOWCAST = True #estimate R_t of the store regions from the onsets of nowcasting.py, corrected for reporting delay
+    #the R_t intervals are those of the rounded nowcast onsets, the bootstrap intervals of the onsets are only written
+    #to nowcast.csv. The projections, the calibration and the windows stay on the reported cases they forecast.
+
+    if PROFILE:
+        profiling.enable()
 
 #change the incidence data to % of positive cases
 #delay in reporting -> change window size
@@ -352,46 +1064,36 @@ if __name__ == "__main__":
 
 
 
-    for i in range(len(select)):
-        fig, axs = plt.subplots(2, 1)
-        name = select[i]
-        print(f"Starting {name}")
-        from_date, end_date = extract_dates_from_txt(name)
-        #plot for R_t estimates
-        plot_surface = axs[1]
-        model_epidemic(name, plot_start_day= 20, window = WINDOW, mean_si= MEAN_SERIAL_INTERVAL, sd_si= STD_SERIAL_INTERVAL, plot_incidence =  True, plot_surface= plot_surface, with_prediction = True)
-        start_date = datetime.date(2020, 2, 28) #
-        delta = datetime.timedelta(days=10)
-        dates = []
-        for i in range(51):
-            dates.append(start_date)
-            start_date += delta
-        dates = [i.strftime("%d-%b") for i in dates] #aligning dates on xaxis
-        plot_surface.set_xticklabels(dates[1:])
-
-        plot_surface.legend()
-        plot_surface.grid()
-        #plot_surface.set_ylim((0, 5))
-
-        plot_surface = axs[0]
-        plot_surface.axhline(1, ls='--', label='1')
-        model_epidemic(name, plot_start_day= 20, window = WINDOW, mean_si= MEAN_SERIAL_INTERVAL, sd_si= STD_SERIAL_INTERVAL, plot_r_t =  True, plot_surface= plot_surface)
-        plot_surface.legend()
-        plot_surface.set_title(f"{name[:-4]} Data with window size = {WINDOW} starting from {from_date} to {end_date}")
-        start_date = datetime.date(2020, 2, 28)
-        delta = datetime.timedelta(days=10)
-        dates = []
-        for i in range(51):
-            dates.append(start_date)
-            start_date += delta
-        dates = [i.strftime("%d-%b") for i in dates]
-        plot_surface.set_xticklabels(dates[1:])
-        plot_surface.legend()
-        plot_surface.grid()
-
-        #plt.tight_layout()
-        fig.set_size_inches(16, 9)
-        plt.savefig(f"Predictions/{name[:-4]}.png", bbox_inches  = 'tight', dpi = 100)
-#        plt.savefig(f"Predictions/{name[:-4]}_{end_date}.pdf", bbox_inches  = 'tight', dpi = 100)
-        print(f"Saved {name}")
-        #plt.show()
+    store_name = incidence_store.STORE_NAME
+    if NOWCAST:
+        with profiling.stage("nowcast"):
+            nowcasting.nowcast_store()
+        store_name = nowcasting.NOWCAST_STORE_NAME
+        print(f"Saved {store_name}.npy and nowcast.csv")
+
+    stores = [store_name if name in names else incidence_store.WORLD_STORE_NAME for name in select]
+    results = run_regions(select, window = WINDOW, mean_si = MEAN_SERIAL_INTERVAL, sd_si = STD_SERIAL_INTERVAL, workers = WORKERS, formats = FORMATS, store_name = stores)
+    failed = [name for name, _, error in results if error is not None]
+    if failed:
+        print(f"Failed regions: {', '.join(failed)}")
+
+    with profiling.stage("projections"):
+        regions, dates, incidence, starts = incidence_store.load_store()
+        w, discarded = truncated_infection_profile_kernel(MEAN_SERIAL_INTERVAL, STD_SERIAL_INTERVAL)
+        means, intervals = project_incidence(incidence, w, WINDOW, horizon = PROJECTION_DAYS, quantiles = PROJECTION_QUANTILES)
+        write_projections("projections.csv", regions, [dates[-1]] * len(regions), means, intervals, PROJECTION_QUANTILES)
+    print("Saved projections.csv")
+
+    with profiling.stage("calibration"):
+        lambdas = lambda_series(incidence, w)
+        coverage, mae, log_score = backtest_forecasts(incidence, w, WINDOW, horizons = BACKTEST_DAYS, level = BACKTEST_LEVEL, start_day = 20, lambdas = lambdas)
+        write_calibration("calibration.csv", regions, WINDOW, coverage, mae, log_score, BACKTEST_LEVEL, discarded)
+    print("Saved calibration.csv")
+
+    best_windows, window_scores = select_window(incidence, w, CANDIDATE_WINDOWS, starts, start_day = 20, lambdas = lambdas)
+    write_windows("windows.csv", regions, CANDIDATE_WINDOWS, best_windows, window_scores, WINDOW)
+    print("Saved windows.csv, windows of the best one day ahead predictions: " + ", ".join(f"{regions[i]} {best_windows[i]}" for i in range(len(regions))))
+
+    if profiling.ENABLED:
+        profiling.dump(PROFILE_FILE)
+        print(f"Saved {PROFILE_FILE}")
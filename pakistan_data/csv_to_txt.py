@@ -1,77 +1,103 @@
 import csv
+import datetime
+import numpy as np
+from incidence_store import STORE_NAME, WORLD_STORE_NAME, write_store
 
-def csv_to_txt(csv_file):
+DATE_FORMAT = '%d-%b-%y' #of the rows of pakistan_data.csv
+
+
+def read_cumulative_csv(csv_file):
+    """
+    :param csv_file: a csv file with a header of names and one row of cumulative cases per date.
+    :return: names, dates and an array of shape (dates, names) of the cumulative cases.
+    """
     with open(csv_file, newline='') as csvfile:
         spamreader = csv.reader(csvfile, delimiter=',', quotechar='|')
-        numbers = {"Pakistan": []}
-        prov_names = []
-        start_date, end_date = str(), str()
-
-        num = 0
+        names = next(spamreader)[1:]
+        dates, rows = [], []
         for row in spamreader:
-            if num == 0:
-                prov_names = row[1:]
-                for i in prov_names:
-                    numbers[i] = []
-            else:
-                data = row[1:] #first two index have date
-                if not start_date:
-                    start_date = row[0]
-                if not data:
-                    print(f"File {csv_file} ended")
-                    return
-                for i in range(len(prov_names)):
-                    numbers[prov_names[i]].append(- sum(numbers[prov_names[i]]) + int(data[i]))
-                numbers["Pakistan"].append(- sum(numbers["Pakistan"]) + sum([int(i) for i in data]))
-
-            end_date = row[0]
-            num += 1
-
-
-
-    for i in numbers:
-        file = open(i+'.txt', "w")
-        data = numbers[i]
-        lines = [str(i + 1) + "\t" + str(data[i]) + '\n' for i in range(len(data))]
-        file.write(f"{start_date},{end_date}\n")
-        file.writelines(lines)
+            data = row[1:] #first index has date
+            if not data:
+                print(f"File {csv_file} ended")
+                break
+            dates.append(row[0])
+            rows.append(data)
+    return names, dates, np.array(rows, dtype = np.int64).reshape(len(rows), len(names))
 
 
-def world_data_to_txt(country_name):
-    countires = ['China', 'US', 'United Kingdom', 'Italy', 'France', 'Germany', 'Spain', 'Iran']
-    country_index=  countires.index(country_name)
-    with open("worldData.csv", newline='') as csvfile:
-        spamreader = csv.reader(csvfile, delimiter=',', quotechar='|')
-        spamreader.__next__() #skipping first line
-        numbers = {country_name: []}
-        epidemic_start = False
-        start_date = str()
-        end_date = str()
+def fill_missing_dates(dates, cumulative, date_format = DATE_FORMAT):
+    """
+    :param dates: the dates of the rows of cumulative, in date_format.
+    :param cumulative: an array of shape (dates, names) of cumulative cases.
+    :return: the dates of every day from the first to the last of dates and the cumulative cases of every day. Days
+    without a row keep the cases of the day before, so the cases reported after a missed day are all on the day they
+    were reported, as a batch, instead of being spread over the missed days.
+    """
+    days = [datetime.datetime.strptime(i, date_format).date() for i in dates]
+    if len(days) == 0 or (days[-1] - days[0]).days == len(days) - 1:
+        return dates, cumulative
+    columns = np.array([(i - days[0]).days for i in days])
+    filled = np.repeat(cumulative, np.diff(columns, append = columns[-1] + 1), axis = 0)
+    return [(days[0] + datetime.timedelta(days = int(i))).strftime(date_format) for i in range(columns[-1] + 1)], filled
 
-        for row in spamreader:
-            if int(row[country_index + 1]) != 0 and not epidemic_start:
-                start_date = row[0]
-                num = 1
-                epidemic_start = True
-            if epidemic_start:
-                #print(num, row[country_index + 1])
-                numbers[country_name].append(- sum(numbers[country_name]) + int(row[country_index + 1]))
-                num += 1
-            end_date = row[0]
-
-    #print(numbers)
-    for i in numbers:
-        file = open(i+'.txt', "w")
-        data = numbers[i]
+
+def write_txt(name, start_date, end_date, data):
+    with open(name + '.txt', "w") as file:
         lines = [str(i + 1) + "\t" + str(data[i]) + '\n' for i in range(len(data))]
         file.write(f"{start_date},{end_date}\n")
         file.writelines(lines)
 
-if __name__ == "__main__":
-    csv_to_txt("pakistan_data.csv")
-    #world_data_to_txt("China")
-    #world_data_to_txt("Spain")
-    #world_data_to_txt("United Kingdom")
-    #world_data_to_txt("Italy")
 
+def csv_to_txt(csv_file, store_name = STORE_NAME):
+    """
+    :param csv_file: the csv file with the cumulative cases of every province.
+    :param store_name: the incidence store to write, None to only write the txt files.
+    :return: None
 
+    Turns the cumulative cases of every province, and of Pakistan as their sum, into daily cases with one np.diff and
+    writes them to one txt file per region and to the incidence store. Dates missing from the csv are filled by
+    fill_missing_dates, so every column is one day.
+    """
+    prov_names, dates, cumulative = read_cumulative_csv(csv_file)
+    dates, cumulative = fill_missing_dates(dates, cumulative)
+    names = ["Pakistan"] + prov_names
+    cumulative = np.column_stack((np.sum(cumulative, axis = 1), cumulative))
+    numbers = np.diff(cumulative, axis = 0, prepend = 0).T #one row of daily cases per region
+
+    for i in range(len(names)):
+        write_txt(names[i], dates[0], dates[-1], numbers[i])
+    if store_name is not None:
+        write_store(store_name, names, dates, numbers)
+
+
+def read_world_data(csv_file = "worldData.csv"):
+    """
+    :param csv_file: a csv file with a header of country names and one row of cumulative cases per date.
+    :return: names, dates, incidence and starts. incidence is an array of shape (names, dates) of daily cases and
+    starts the first column of every series, the day of its first case, len(dates) for series without cases.
+
+    The file is read once whatever its number of columns, the starts of all the series are found and all the
+    columns are differenced together.
+    """
+    names, dates, cumulative = read_cumulative_csv(csv_file)
+    names = [i.replace("_", " ") for i in names]
+    started = cumulative != 0
+    starts = np.where(started.any(axis = 0), started.argmax(axis = 0), len(dates))
+    incidence = np.diff(cumulative, axis = 0, prepend = 0).T #zero before the start of every series
+    return names, dates, incidence, starts
+
+
+def world_data_to_store(csv_file = "worldData.csv", store_name = WORLD_STORE_NAME):
+    """
+    :param csv_file: the csv file with the cumulative cases of every country.
+    :param store_name: the incidence store to write.
+    :return: the names of the series in the store.
+    """
+    names, dates, incidence, starts = read_world_data(csv_file)
+    write_store(store_name, names, dates, incidence, starts)
+    return names
+
+
+if __name__ == "__main__":
+    csv_to_txt("pakistan_data.csv")
+    world_data_to_store("worldData.csv")
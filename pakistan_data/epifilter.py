@@ -0,0 +1,199 @@
+"""
+Bayesian recursive filtering and smoothing of R_t on a grid, following EpiFilter (Parag 2021). R_t does a random walk
+whose variance is eta^2 R_t, which is close to a walk of constant variance (eta / 2)^2 in sqrt(R_t). The grid is
+therefore uniform in sqrt(R_t) and the transition is a Gaussian convolution along the grid, applied with DCTs, instead
+of a dense matrix. The incident cases of day t are poisson with mean R_t * lambda_t.
+"""
+import numpy as np
+from scipy import fft
+import csv
+import time
+import analysis
+import nowcasting
+import incidence_store
+
+R_MAX = 10 #largest R_t of the grid
+GRID_POINTS = 2000
+ETA = 0.1 #R_t changes by about eta * sqrt(R_t) a day
+JUMP = 1e-4 #probability a day that R_t jumps anywhere on the grid, keeps the tails above the round off of float32
+BLOCK = 50 #points of the blocks of the grid the quantiles are searched in
+WORKERS = -1 #threads of the transforms, -1 uses every core
+
+
+def r_t_grid(r_max = R_MAX, points = GRID_POINTS):
+    """
+    :return: the values of R_t of the grid, uniform in sqrt(R_t) from sqrt(r_max) / points to sqrt(r_max).
+    """
+    return np.linspace(0, np.sqrt(r_max), points + 1)[1:] ** 2
+
+
+def gaussian_transition(points, sigma, jump = JUMP, workers = WORKERS):
+    """
+    :param points: the number of points of the grid.
+    :param sigma: the standard deviation of the walk in grid points.
+    :param jump: the probability of moving to a uniformly drawn point instead.
+    :param workers: threads of the transforms, -1 uses every core.
+    :return: a function applying the walk to the last axis of a float32 array of probabilities.
+
+    The grid is reflected at both ends, like scipy.ndimage.gaussian_filter1d with mode 'reflect', so no mass is lost.
+    A symmetric kernel on a grid reflected this way is diagonal in the DCT-II, so the walk is a DCT of the grid, a
+    product with the transfer of the kernel and an inverse DCT, without padding. Without the jumps, tails further than
+    a few sigma fall below the round off of the transforms and a sudden change of R_t could not be followed. The
+    operator is symmetric, so it is also its own transpose in the smoother.
+    """
+    radius = min(max(int(4 * sigma + 0.5), 1), points - 1)
+    offsets = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (offsets / max(sigma, 1e-12)) ** 2)
+    kernel /= np.sum(kernel)
+    transfer = ((1 - jump) * kernel @ np.cos(np.pi * np.outer(offsets, np.arange(points)) / points)).astype(np.float32)
+    spread = np.full(points, jump / points, dtype = np.float32)
+
+    def transition(probabilities):
+        spectrum = fft.dct(probabilities, axis = -1, workers = workers)
+        spectrum *= transfer
+        moved = fft.idct(spectrum, axis = -1, overwrite_x = True, workers = workers)
+        np.maximum(moved, 0, out = moved) #removing round off below zero
+        moved += (probabilities @ spread)[..., np.newaxis]
+        return moved
+    return transition
+
+
+def summaries(posteriors, grid, quantiles, block = BLOCK):
+    """
+    :param posteriors: an array of probabilities over the grid along the last axis.
+    :param grid: the values of the grid.
+    :param quantiles: the quantiles to return.
+    :param block: the number of points of the blocks of the grid.
+    :return: the means and the quantiles of the posteriors, quantiles have one more leading axis of len(quantiles).
+
+    The quantiles are searched in a single cdf of the sums of blocks of the grid, then in the cdf of the block they
+    fall in, so only the blocks are summed along the whole grid. The blocks of every posterior are searched by one
+    searchsorted, each cdf is offset by twice its row so the cdfs laid end to end still increase. The sums and cdfs are
+    products with ones and upper triangular ones, which are much faster than sum and cumsum on short rows.
+    """
+    points = posteriors.shape[-1]
+    flat = posteriors.reshape((-1, points))
+    rows = np.arange(len(flat))
+    means = flat @ grid.astype(flat.dtype)
+    if points % block:
+        flat = np.pad(flat, ((0, 0), (0, block - points % block)))
+    blocks = flat.reshape((len(flat), -1, block))
+    n = blocks.shape[1]
+    upper = np.triu(np.ones((max(n, block),) * 2, dtype = flat.dtype))
+
+    block_cdf = (blocks @ np.ones(block, dtype = flat.dtype)) @ upper[:n, :n]
+    targets = np.asarray(quantiles, dtype = float)[:, np.newaxis]
+    found = np.searchsorted((block_cdf + 2 * rows[:, np.newaxis]).ravel(), targets + 2 * rows) - rows * n
+    found = np.minimum(found, n - 1)
+    remaining = targets - np.where(found > 0, block_cdf[rows, found - 1], 0) #(quantiles, rows)
+    cdf = blocks[rows, found] @ upper[:block, :block]
+    indices = np.minimum(found * block + np.sum(cdf < remaining[..., np.newaxis], axis = -1), points - 1)
+    return means.reshape(posteriors.shape[:-1]), grid[indices].reshape((len(quantiles),) + posteriors.shape[:-1])
+
+
+def filter_R_t(incidence, w, eta = ETA, r_max = R_MAX, points = GRID_POINTS, quantiles = (0.025, 0.975), smooth = True, lambdas = None, workers = WORKERS):
+    """
+    :param incidence: an array of incident cases, incidence[..., s] is the number of incident cases on day s. Leading
+    axes are regions, all filtered together.
+    :param w: infectious profile, an ndarray kernel or a function with signature w(t).
+    :param eta: the scale of the random walk of R_t.
+    :param r_max, points: the grid of R_t.
+    :param quantiles: the quantiles of the posteriors to return.
+    :param smooth: whether to also run the backward smoother.
+    :param lambdas: optional output of lambda_series(incidence, w).
+    :param workers: threads of the transforms, -1 uses every core.
+    :return: (means, intervals) of the filtered posteriors, of R_t on day t given the cases up to day t, and the
+    same for the smoothed posteriors, given every day, or None when smooth is False. means has the shape of incidence
+    and intervals has one more leading axis of len(quantiles).
+
+    The prior on the first day is uniform over the grid. Days without infectiousness (lambda_t = 0) or with negative
+    counts carry no information. The likelihoods are float32, taken relative to their largest value over the grid,
+    which is known in closed form at R_t = cases / lambda_t. The predicted priors of the forward pass are kept as a
+    float32 (days, regions, points) array, so the smoother only applies the walk once a day, to the ratio of the
+    smoothed posterior to the prior of the next day.
+    """
+    incidence = np.asarray(incidence, dtype = float)
+    if lambdas is None:
+        lambdas = analysis.lambda_series(incidence, w)
+    shape, T = incidence.shape[:-1], incidence.shape[-1]
+    incidence = incidence.reshape((-1, T))
+    lambdas = np.broadcast_to(lambdas[..., :T], shape + (T,)).reshape((-1, T))
+    informative = (lambdas > 0) & (incidence >= 0)
+    cases, lambdas = np.where(informative, incidence, 0), np.where(informative, lambdas, 0)
+
+    grid = r_t_grid(r_max, points)
+    peak = np.clip(np.divide(cases, lambdas, out = np.ones_like(cases), where = lambdas > 0), grid[0], grid[-1])
+    largest = cases * np.log(peak) - lambdas * peak
+    #log likelihood = cases * log(R) - lambda * R - largest, one product of (regions, 3) and (3, points) a day
+    coefficients = np.stack((cases, -lambdas, -largest), axis = -1).astype(np.float32) #(regions, days, 3)
+    basis = np.stack((np.log(grid), grid, np.ones(points))).astype(np.float32)
+    ones = basis[2]
+    transition = gaussian_transition(points, (eta / 2) / (np.sqrt(r_max) / points), workers = workers)
+
+    def likelihood(t, out):
+        np.matmul(coefficients[:, t], basis, out = out)
+        return np.exp(out, out = out)
+
+    def results(means, intervals): #from (days, regions) to the shape of incidence
+        return np.moveaxis(means, 0, -1).reshape(shape + (T,)), np.moveaxis(intervals, 1, -1).reshape((len(quantiles),) + shape + (T,))
+
+    N = len(incidence)
+    means, intervals = np.empty((T, N)), np.empty((len(quantiles), T, N))
+    priors = np.empty((T, N, points), dtype = np.float32)
+    posterior = np.full((N, points), 1 / points, dtype = np.float32)
+    for t in range(T):
+        priors[t] = transition(posterior) if t > 0 else posterior
+        posterior = likelihood(t, np.empty((N, points), dtype = np.float32))
+        posterior *= priors[t]
+        posterior /= (posterior @ ones)[:, np.newaxis]
+        means[t], intervals[:, t] = summaries(posterior, grid, quantiles)
+    filtered = results(means, intervals)
+    if not smooth:
+        return filtered, None
+
+    means, intervals = means.copy(), intervals.copy() #the last day is already smoothed
+    smoothed = posterior
+    for t in range(T - 2, -1, -1):
+        smoothed /= priors[t + 1] #the priors hold at least jump / points
+        smoothed = transition(smoothed)
+        smoothed *= priors[t]
+        smoothed *= likelihood(t, np.empty((N, points), dtype = np.float32)) #the filtered posterior of day t, up to a constant
+        smoothed /= (smoothed @ ones)[:, np.newaxis]
+        means[t], intervals[:, t] = summaries(smoothed, grid, quantiles)
+    return filtered, results(means, intervals)
+
+
+def write_estimates(file_name, regions, dates, filtered, smoothed, quantiles):
+    """
+    :param file_name: the csv file to write.
+    :param regions, dates: the names of the regions and the dates of the columns of the store.
+    :param filtered, smoothed: outputs of filter_R_t for the regions.
+    :param quantiles: the quantiles of the intervals.
+    :return: None
+    """
+    with open(file_name, newline='', mode='w') as csvfile:
+        spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|')
+        spamwriter.writerow(["Region", "Date", "Filtered mean"] + [f"Filtered Q{q}" for q in quantiles] +
+                            ["Smoothed mean"] + [f"Smoothed Q{q}" for q in quantiles])
+        for i in range(len(regions)):
+            for j in range(len(dates)):
+                row = [regions[i], dates[j]]
+                for means, intervals in (filtered, smoothed):
+                    row += [round(means[i, j], 3)] + [round(intervals[k, i, j], 3) for k in range(len(quantiles))]
+                spamwriter.writerow(row)
+
+
+if __name__ == "__main__":
+    MEAN_SERIAL_INTERVAL = 4
+    STD_SERIAL_INTERVAL = 5
+    QUANTILES = (0.025, 0.975)
+
+    #the nowcast onsets written by analysis.py, the same series as the published windowed R_t
+    regions, dates, incidence, starts = incidence_store.load_store(nowcasting.NOWCAST_STORE_NAME)
+    w, discarded = analysis.truncated_infection_profile_kernel(MEAN_SERIAL_INTERVAL, STD_SERIAL_INTERVAL)
+    start = time.perf_counter()
+    filtered, smoothed = filter_R_t(incidence, w, quantiles = QUANTILES)
+    seconds = time.perf_counter() - start
+    write_estimates("epifilter.csv", regions, dates, filtered, smoothed, QUANTILES)
+    print(f"Saved epifilter.csv, {incidence.shape[0]} regions x {incidence.shape[1]} days filtered and smoothed in {seconds:.2f}s, "
+          f"discarding a serial interval tail of {discarded:.1e}")
@@ -0,0 +1,112 @@
+"""
+Concurrent fetching of the daily cumulative cases. Every source is requested over one pooled aiohttp session with a
+timeout and retries, sending the ETag and Last-Modified of the previous run so unchanged pages cost a 304. The cases
+of the sources that changed are merged and written to the tail of the csv with scrap_data_to_csv.write_to_csv.
+"""
+import os
+import json
+import asyncio
+import aiohttp
+import scrap_data_to_csv
+
+SOURCES = {"geo": ("https://www.geo.tv/", scrap_data_to_csv.parse_banner)} #name -> (url, parser of the page)
+CACHE_FILE = "./pakistan_data/fetch_cache.json" #ETag and Last-Modified of every url
+TIMEOUT = 30 #seconds
+RETRIES = 3
+BACKOFF = 1 #seconds before the first retry, doubled after every retry
+CONNECTIONS = 8
+
+
+def load_cache(file_name = CACHE_FILE):
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name) as cache_file:
+        return json.load(cache_file)
+
+
+def save_cache(cache, file_name = CACHE_FILE):
+    with open(file_name, "w") as cache_file:
+        json.dump(cache, cache_file, indent = 1)
+
+
+async def fetch(session, url, cache, retries = RETRIES, backoff = BACKOFF):
+    """
+    :param session: an aiohttp.ClientSession.
+    :param url: the url to get.
+    :param cache: a dict url -> {"etag", "last_modified"}, updated with the validators of the response.
+    :return: the text of the page, or None when the server answers that it has not been modified.
+
+    Connection errors, timeouts and server errors are retried with exponential backoff, the last one is raised.
+    """
+    headers = {}
+    validators = cache.get(url, {})
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url, headers = headers) as response:
+                if response.status == 304:
+                    return None
+                response.raise_for_status()
+                text = await response.text()
+                cache[url] = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+                return text
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError, aiohttp.ClientResponseError) as error:
+            retriable = not isinstance(error, aiohttp.ClientResponseError) or error.status >= 500
+            if not retriable or attempt == retries:
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def fetch_all(urls, cache, timeout = TIMEOUT, connections = CONNECTIONS, retries = RETRIES, backoff = BACKOFF):
+    """
+    :param urls: a dict name -> url.
+    :param cache: the validators of the previous run, updated in place.
+    :return: a dict name -> text of the page, None when not modified, or the exception that made it fail.
+    """
+    connector = aiohttp.TCPConnector(limit = connections)
+    async with aiohttp.ClientSession(connector = connector, timeout = aiohttp.ClientTimeout(total = timeout)) as session:
+        pages = await asyncio.gather(*(fetch(session, url, cache, retries, backoff) for url in urls.values()),
+                                     return_exceptions = True)
+    return dict(zip(urls, pages))
+
+
+def merge_sources(results):
+    """
+    :param results: a list of the cumulative cases of every province, one per source.
+    :return: the largest count of every province, the sources report cumulative cases so the largest is the latest.
+    """
+    return [max(i) for i in zip(*results)]
+
+
+def update(csv_file = scrap_data_to_csv.CSV_FILE, sources = SOURCES, cache_file = CACHE_FILE, date = None, **options):
+    """
+    :param csv_file: the csv file of cumulative cases to update.
+    :param sources: a dict name -> (url, parser), parser turns the page into the cumulative cases of every province.
+    :param cache_file: the json file of the ETag and Last-Modified of every url.
+    :param date: the date of the cases, today in Pakistan by default.
+    :param options: passed to fetch_all.
+    :return: the rows written to the csv, empty when no source changed.
+    """
+    cache = load_cache(cache_file)
+    pages = asyncio.run(fetch_all({name: url for name, (url, parser) in sources.items()}, cache, **options))
+
+    results = []
+    for name, page in pages.items():
+        if isinstance(page, Exception):
+            print(f"{name}: failed with {page!r}")
+        elif page is None:
+            print(f"{name}: not modified")
+        else:
+            results.append(sources[name][1](page))
+    rows = scrap_data_to_csv.write_to_csv(merge_sources(results), csv_file, date) if results else []
+    save_cache(cache, cache_file)
+    return rows
+
+
+if __name__ == "__main__":
+    for row in update():
+        print(",".join(str(i) for i in row))
@@ -0,0 +1,103 @@
+import numpy as np
+import itertools
+import csv
+import time
+from concurrent.futures import ProcessPoolExecutor
+import analysis
+import incidence_store
+
+
+def score_serial_interval(incidence, starts, mean_si, sd_si, windows, start_day):
+    """
+    :param incidence: an array of shape (regions, days) of incident cases.
+    :param starts: the first day of the series of every region.
+    :param mean_si: Mean of the serial interval
+    :param sd_si: standard deviation of serial interval
+    :param windows: the window sizes to score.
+    :param start_day: the first day after the start of every region to score.
+    :return: scores, an ndarray of shape (len(windows), regions), the sum of the one day ahead log likelihoods, and
+    discarded, the mass of the tail of the serial interval cut off its kernel.
+
+    The kernel and lambda are computed once and every window is scored in a single pass by analysis.select_window.
+    Every window scores the same days, from start_day or the largest window on, so the sums can be compared.
+    """
+    w, discarded = analysis.truncated_infection_profile_kernel(mean_si, sd_si)
+    best, scores = analysis.select_window(incidence, w, windows, starts, start_day)
+    return scores, discarded
+
+
+def grid_search(incidence, starts, windows, mean_sis, sd_sis, start_day = 20, workers = None):
+    """
+    :param incidence: an array of shape (regions, days) of incident cases.
+    :param starts: the first day of the series of every region.
+    :param windows, mean_sis, sd_sis: the values of the window size, mean and SD of the serial interval to combine.
+    :param start_day: the first day after the start of every region to score.
+    :param workers: number of worker processes, None uses every core and 1 runs in this process.
+    :return: scores, an ndarray of shape (len(windows), len(mean_sis), len(sd_sis), regions) of the one day ahead log
+    likelihoods, and discarded, of shape (len(mean_sis), len(sd_sis)), the tail of every serial interval cut off its kernel.
+
+    Every (mean_si, sd_si) pair is scored for all windows at once, the pairs are spread over a process pool.
+    """
+    incidence = np.asarray(incidence)
+    pairs = list(itertools.product(mean_sis, sd_sis))
+    args = [(incidence, starts, mean_si, sd_si, windows, start_day) for mean_si, sd_si in pairs]
+
+    if workers == 1:
+        results = [score_serial_interval(*i) for i in args]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = list(executor.map(score_serial_interval, *zip(*args)))
+
+    scores, discarded = zip(*results)
+    scores = np.stack(scores, axis = 1) #(windows, pairs, regions)
+    discarded = np.reshape(discarded, (len(mean_sis), len(sd_sis)))
+    return scores.reshape((len(windows), len(mean_sis), len(sd_sis), len(incidence))), discarded
+
+
+def ranked_table(scores, windows, mean_sis, sd_sis, region):
+    """
+    :param scores: the output of grid_search.
+    :param region: the index of the region to rank.
+    :return: a list of (log likelihood, window, mean_si, sd_si, j, k), best first, j and k index mean_sis and sd_sis.
+    """
+    table = []
+    for i, j, k in itertools.product(range(len(windows)), range(len(mean_sis)), range(len(sd_sis))):
+        table.append((scores[i, j, k, region], windows[i], mean_sis[j], sd_sis[k], j, k))
+    return sorted(table, key = lambda row: row[0], reverse = True)
+
+
+def write_ranked_tables(file_name, regions, scores, discarded, windows, mean_sis, sd_sis):
+    """
+    :param file_name: the csv file to write.
+    :param regions: the names of the regions of scores.
+    :param scores, discarded: the outputs of grid_search.
+    :return: None
+
+    Writes the ranked table of every region, every combination with its rank, best first, and the tail of its serial
+    interval that the kernel left out.
+    """
+    with open(file_name, newline='', mode='w') as csvfile:
+        spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|')
+        spamwriter.writerow(["Region", "Rank", "Log likelihood", "Window", "Mean SI", "SD SI", "Discarded SI tail"])
+        for r in range(len(regions)):
+            for rank, (log_likelihood, window, mean_si, sd_si, j, k) in enumerate(ranked_table(scores, windows, mean_sis, sd_sis, r)):
+                spamwriter.writerow([regions[r], rank + 1, round(log_likelihood, 1), window, mean_si, sd_si, f"{discarded[j, k]:.1e}"])
+
+
+if __name__ == "__main__":
+    WINDOWS = list(range(1, 15))
+    MEAN_SERIAL_INTERVALS = [3, 4, 4.7, 5.5, 6.5, 8.4]
+    STD_SERIAL_INTERVALS = [1.5, 2.9, 3.8, 5]
+    START_DAY = 20
+    TOP = 5
+
+    regions, dates, incidence, starts = incidence_store.load_store()
+    start = time.perf_counter()
+    scores, discarded = grid_search(incidence, starts, WINDOWS, MEAN_SERIAL_INTERVALS, STD_SERIAL_INTERVALS, start_day = START_DAY)
+    write_ranked_tables("grid_search.csv", regions, scores, discarded, WINDOWS, MEAN_SERIAL_INTERVALS, STD_SERIAL_INTERVALS)
+    print(f"Saved grid_search.csv in {time.perf_counter() - start:.2f}s, discarding serial interval tails of at most {np.max(discarded):.1e}")
+    for r in range(len(regions)):
+        print(regions[r])
+        print("log likelihood\twindow\tmean_si\tsd_si")
+        for log_likelihood, window, mean_si, sd_si, j, k in ranked_table(scores, WINDOWS, MEAN_SERIAL_INTERVALS, STD_SERIAL_INTERVALS, r)[:TOP]:
+            print(f"{log_likelihood:.1f}\t{window}\t{mean_si}\t{sd_si}")
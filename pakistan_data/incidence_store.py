@@ -0,0 +1,77 @@
+import json
+import numpy as np
+
+STORE_NAME = "incidence" #incidence.npy holds the regions x days matrix, incidence.json the regions, dates and starts
+WORLD_STORE_NAME = "world" #the countries of worldData.csv
+
+
+def write_store(store_name, regions, dates, incidence, starts = None):
+    """
+    :param store_name: path of the store without extension.
+    :param regions: names of the series, one per row of incidence.
+    :param dates: the date of every column of incidence.
+    :param incidence: an array of shape (regions, days), incidence[r, s] is the number of incident cases of region r on day s.
+    :param starts: the first column of the series of every region, 0 for every region by default.
+    :return: None
+    """
+    incidence = np.ascontiguousarray(incidence, dtype = np.int64)
+    assert incidence.shape == (len(regions), len(dates))
+    if starts is None:
+        starts = [0] * len(regions)
+
+    np.save(store_name + ".npy", incidence)
+    with open(store_name + ".json", "w") as index_file:
+        json.dump({"regions": list(regions), "dates": list(dates), "starts": [int(i) for i in starts]}, index_file)
+
+
+def load_store(store_name = STORE_NAME, mmap_mode = "r"):
+    """
+    :param store_name: path of the store without extension.
+    :param mmap_mode: passed to np.load, the matrix is memory-mapped read only by default.
+    :return: regions, dates, incidence, starts. incidence is the (regions x days) matrix and starts an array with the
+    first column of the series of every region.
+    """
+    with open(store_name + ".json") as index_file:
+        index = json.load(index_file)
+    incidence = np.load(store_name + ".npy", mmap_mode = mmap_mode)
+    return index["regions"], index["dates"], incidence, np.array(index["starts"])
+
+
+def read_region(region, store_name = STORE_NAME):
+    """
+    :param region: name of the region to read.
+    :param store_name: path of the store without extension.
+    :return: two arrays denoting days and no_of_cases (I_t), like read_file. no_of_cases is a view of the memory-mapped
+    store, nothing is copied.
+    """
+    regions, dates, incidence, starts = load_store(store_name)
+    row = regions.index(region)
+    incidence_data = incidence[row, starts[row]:]
+    return list(range(1, len(incidence_data) + 1)), incidence_data
+
+
+def region_dates(region, store_name = STORE_NAME):
+    """
+    :return: the first and the last date of the series of the region.
+    """
+    regions, dates, incidence, starts = load_store(store_name)
+    return dates[starts[regions.index(region)]], dates[-1]
+
+
+def load_regions(regions, store_names):
+    """
+    :param regions: names of the regions to read.
+    :param store_names: the store of every region.
+    :return: incidence, starts, like load_store, for the regions in order. The stores are aligned on their last day, so
+    column -1 is the last reported day of every region. Days before the first day of a shorter store are zeros and the
+    starts of its regions are moved by the difference.
+    """
+    stores = {name: load_store(name) for name in dict.fromkeys(store_names)}
+    days = max(len(dates) for _, dates, _, _ in stores.values())
+    incidence, starts = np.zeros((len(regions), days), dtype = np.int64), np.zeros(len(regions), dtype = np.int64)
+    for i, (region, store_name) in enumerate(zip(regions, store_names)):
+        names, dates, store, store_starts = stores[store_name]
+        row = names.index(region)
+        incidence[i, days - len(dates):] = store[row]
+        starts[i] = days - len(dates) + store_starts[row]
+    return incidence, starts
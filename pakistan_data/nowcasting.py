@@ -0,0 +1,195 @@
+"""
+Nowcasting of the incidence by onset day from the reported cases. A case with onset on day u is reported on day
+u + d with probability f(d), so the reported cases are the onsets convolved with the reporting delay, and the onsets
+of the last days are not fully reported yet. The onsets are recovered by Richardson-Lucy deconvolution (the EM
+algorithm of Goldstein et al. 2009) with the right truncation correction: the back projection of every onset day is
+divided by the probability that its cases have been reported by the last day. The convolutions are applied with
+real FFTs of precomputed kernels and every region and bootstrap sample is deconvolved in the same arrays.
+
+The nightly analysis.py estimates R_t from the rounded onsets of the nowcast store. The bootstrap intervals of the
+onsets are written to nowcast.csv only, they are not carried into the intervals of R_t.
+"""
+import numpy as np
+from scipy import stats, fft, ndimage
+import csv
+import incidence_store
+
+NOWCAST_STORE_NAME = "nowcast" #the nowcast onsets of the regions of the incidence store
+DELAY_MEAN = 5 #days from onset to report, an assumed gamma until the delays of a line list are available
+DELAY_SD = 3
+DELAY_TOLERANCE = 1e-6 #mass of the tail of the delay that is discarded
+ITERATIONS = 50 #at most, a series stops once its fit is within the poisson noise of its reports
+MIN_REPORTED = 0.5 #the last onset days, reported with a smaller probability, are left out of the nowcast store
+DISPERSION_DAYS = 7 #the noise of the reports is measured around their moving average over this many days
+
+
+def delay_distribution(mean = DELAY_MEAN, sd = DELAY_SD, tolerance = DELAY_TOLERANCE):
+    """
+    :param mean, sd: mean and standard deviation of the gamma distribution of the delay from onset to report.
+    :param tolerance: the mass of the tail of the delay that may be discarded.
+    :return: an ndarray delay where delay[d] is the probability that a case is reported d days after its onset, from
+    d = 0 to the first day whose tail holds less than tolerance, normalized to sum to 1.
+    """
+    shape, scale = (mean / sd) ** 2, sd ** 2 / mean
+    D = int(np.ceil(stats.gamma.ppf(1 - tolerance, shape, scale = scale)))
+    delay = np.diff(stats.gamma.cdf(np.arange(D + 2), shape, scale = scale))
+    return delay / np.sum(delay)
+
+
+def delay_operators(delay, days):
+    """
+    :param delay: the output of delay_distribution, D + 1 days long.
+    :param days: the number T of reported days.
+    :return: convolve and correlate, acting on the last axis. convolve maps the onsets of the T + D days from day -D
+    to day T - 1 to the expected reports of days 0 to T - 1. correlate maps the reports of days 0 to T - 1 back to the
+    onset days, correlate(reports)[..., u] = sum over s of delay[s + D - u] * reports[..., s].
+    """
+    D = len(delay) - 1
+    n = fft.next_fast_len(days + 2 * D, real = True) #the longest linear convolution is T + 2D - 1 days
+    forward = fft.rfft(delay, n)
+    backward = fft.rfft(delay[::-1], n)
+
+    def convolve(onsets):
+        return fft.irfft(fft.rfft(onsets, n, axis = -1) * forward, n, axis = -1)[..., D:D + days]
+
+    def correlate(reports):
+        return fft.irfft(fft.rfft(reports, n, axis = -1) * backward, n, axis = -1)[..., :days + D]
+    return convolve, correlate
+
+
+def dispersion(reports, days = DISPERSION_DAYS):
+    """
+    :param reports: an array of reported cases, reports[..., s] is the number of cases reported on day s.
+    :param days: the length of the centred moving average the noise is measured around.
+    :return: an ndarray of the leading shape of reports, the ratio of the variance to the mean of the reports of every
+    series around its moving average, at least 1. It is 1 for poisson reports and larger when cases are reported in
+    batches. Days before the first report are left out.
+    """
+    reports = np.maximum(np.asarray(reports, dtype = float), 0)
+    average = ndimage.uniform_filter1d(reports, days, axis = -1, mode = 'nearest')
+    residuals = np.divide((reports - average) ** 2, average, out = np.zeros_like(reports), where = average > 0)
+    ratio = np.sum(residuals, axis = -1) / np.maximum(np.sum(average > 0, axis = -1), 1) / (1 - 1 / days)
+    return np.maximum(ratio, 1)
+
+
+def deconvolve(reports, delay, iterations = ITERATIONS, noise = None):
+    """
+    :param reports: an array of reported cases, reports[..., s] is the number of cases reported on day s. Leading axes,
+    e.g. bootstrap samples and regions, are deconvolved together.
+    :param delay: the output of delay_distribution.
+    :param iterations: the largest number of Richardson-Lucy iterations.
+    :param noise: the output of dispersion(reports), or an array broadcast against it.
+    :return: onsets, of the shape of reports, the estimated number of cases with onset on every reported day,
+    reported, of length T, the probability that a case with onset on day u has been reported by the last day, and
+    expected, of the shape of reports, the reports expected from the estimated onsets.
+
+    The onsets are estimated on the D days before the first reported day as well, so the early reports are explained
+    by earlier onsets, and those days are dropped from the output. The first guess is the moving average of the
+    reports moved back by the mean delay. Negative counts are read as zero. Further iterations fit the noise of the
+    reports, so as in Goldstein et al. every series stops once the poisson chi square per day of its expected reports
+    falls to 1, or to its dispersion when cases are reported in batches, while the other series go on. The first
+    iteration, which applies the right truncation correction, is always done. The onsets of the last days are
+    divided by small probabilities of being reported, drop them using reported.
+    """
+    reports = np.maximum(np.asarray(reports, dtype = float), 0)
+    T, D = reports.shape[-1], len(delay) - 1
+    convolve, correlate = delay_operators(delay, T)
+    reported = correlate(np.ones(T)) #probability that an onset of day u - D is reported by day T - 1
+    if noise is None:
+        noise = dispersion(reports)
+
+    shift = int(round(np.sum(np.arange(D + 1) * delay)))
+    average = ndimage.uniform_filter1d(reports, DISPERSION_DAYS, axis = -1, mode = 'nearest')
+    onsets = np.take(average, np.clip(np.arange(T + D) - D + shift, 0, T - 1), axis = -1)
+    onsets = np.maximum(onsets, 1e-3) #days starting at zero would stay zero
+    shape = reports.shape
+    reports, onsets = reports.reshape((-1, T)), onsets.reshape((-1, T + D))
+    noise = np.broadcast_to(noise, shape[:-1]).reshape(-1)
+    rows = np.arange(len(reports)) #the series still iterating, only they are transformed
+    for i in range(iterations):
+        expected = convolve(onsets[rows])
+        if i > 0:
+            chi_square = np.mean(np.divide((expected - reports[rows]) ** 2, expected, out = np.zeros_like(expected), where = expected > 1e-12), axis = -1)
+            going_on = chi_square > noise[rows]
+            rows, expected = rows[going_on], expected[going_on]
+        if len(rows) == 0:
+            break
+        ratio = np.divide(reports[rows], expected, out = np.zeros_like(expected), where = expected > 1e-12)
+        onsets[rows] *= np.maximum(correlate(ratio), 0) / reported #removing round off below zero
+    onsets = onsets.reshape(shape[:-1] + (T + D,))
+    return onsets[..., D:], reported[D:], convolve(onsets)
+
+
+def nowcast(reports, delay, n_bootstrap = 100, quantiles = (0.025, 0.975), iterations = ITERATIONS, rng = None):
+    """
+    :param reports: an array of reported cases, reports[..., s] is the number of cases reported on day s. Leading
+    axes, e.g. regions, are nowcast together.
+    :param delay: the output of delay_distribution.
+    :param n_bootstrap: the number of bootstrap samples of the reports.
+    :param quantiles: the quantiles of the bootstrap onsets to return.
+    :param rng: a numpy.random.Generator, a new unseeded one is used by default.
+    :return: onsets, of the shape of reports, deconvolved from the reports, intervals, of shape
+    (len(quantiles),) + reports.shape, from the bootstrap samples, and reported, the output of deconvolve.
+
+    Every bootstrap sample draws the reports of every day around the reports expected from the deconvolved onsets,
+    from a negative binomial with the dispersion of the reports of the series (a poisson when it is 1). All the
+    samples of every region are deconvolved in a single call.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    noise = dispersion(reports)
+    onsets, reported, expected = deconvolve(reports, delay, iterations, noise)
+    expected = np.maximum(expected, 1e-12)
+    excess = np.maximum(noise - 1, 1e-9)[..., np.newaxis] #gamma mixed poisson, variance = noise * mean
+    samples = rng.poisson(rng.gamma(expected / excess, excess, size = (n_bootstrap,) + expected.shape))
+    sampled_onsets, reported, expected = deconvolve(samples, delay, iterations, noise)
+    return onsets, np.quantile(sampled_onsets, quantiles, axis = 0), reported
+
+
+def write_nowcast(file_name, regions, dates, reports, onsets, intervals, reported, quantiles):
+    """
+    :param file_name: the csv file to write.
+    :param regions, dates: the names of the regions and the dates of the columns of the store.
+    :param reports: the reported cases of the regions.
+    :param onsets, intervals, reported: outputs of nowcast for the regions.
+    :param quantiles: the quantiles of intervals.
+    :return: None
+    """
+    with open(file_name, newline='', mode='w') as csvfile:
+        spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|')
+        spamwriter.writerow(["Region", "Date", "Reported", "Probability reported", "Onsets"] + [f"Q{q}" for q in quantiles])
+        for i in range(len(regions)):
+            for j in range(len(dates)):
+                spamwriter.writerow([regions[i], dates[j], int(reports[i, j]), round(reported[j], 3), round(onsets[i, j], 1)] +
+                                    [round(intervals[k, i, j], 1) for k in range(len(quantiles))])
+
+
+def nowcast_store(store_name = incidence_store.STORE_NAME, nowcast_store_name = NOWCAST_STORE_NAME, delay = None,
+                  csv_file = "nowcast.csv", quantiles = (0.025, 0.975), min_reported = MIN_REPORTED, **options):
+    """
+    :param store_name: the store of reported cases.
+    :param nowcast_store_name: the store to write the rounded nowcast onsets to, with the regions and starts of the
+    reported cases.
+    :param delay: the output of delay_distribution, delay_distribution() by default.
+    :param csv_file: the csv file to write the nowcast of every day with its intervals to, or None.
+    :param min_reported: the last days, reported with a smaller probability, are left out of the nowcast store.
+    :param options: passed to nowcast.
+    :return: None
+
+    The store holds the point nowcast only, the bootstrap intervals are in csv_file.
+    """
+    if delay is None:
+        delay = delay_distribution()
+    regions, dates, reports, starts = incidence_store.load_store(store_name)
+    onsets, intervals, reported = nowcast(reports, delay, quantiles = quantiles, **options)
+    kept = reported >= min_reported
+    incidence_store.write_store(nowcast_store_name, regions, list(np.array(dates)[kept]), np.round(onsets[:, kept]), starts)
+    if csv_file is not None:
+        write_nowcast(csv_file, regions, dates, reports, onsets, intervals, reported, quantiles)
+
+
+if __name__ == "__main__":
+    N_BOOTSTRAP = 100
+
+    nowcast_store(n_bootstrap = N_BOOTSTRAP)
+    print(f"Saved {NOWCAST_STORE_NAME}.npy and nowcast.csv")
@@ -0,0 +1,106 @@
+"""
+Opt-in timing of the stages of the daily pipeline. Set the environment variable COVID_PROFILE=1, or call enable(),
+then stages are timed with `with profiling.stage(name):`, calls are counted with profiling.count(name) and the
+totals of every region are written with dump(). When disabled, stage returns a shared no-op context manager and
+count returns at once.
+"""
+import os
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+ENABLED = os.environ.get("COVID_PROFILE", "0") not in ("", "0")
+PROFILE_FILE = "profile.json"
+
+_DISABLED = nullcontext()
+_records = {} #region -> {"stages": {name: [calls, seconds]}, "counts": {name: calls}}
+_region = "all"
+
+
+def enable(enabled = True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def _record():
+    if _region not in _records:
+        _records[_region] = {"stages": {}, "counts": {}}
+    return _records[_region]
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        stages = _record()["stages"]
+        total = stages.setdefault(self.name, [0, 0.0])
+        total[0] += 1
+        total[1] += seconds
+        return False
+
+
+def stage(name):
+    """A context manager adding its wall time to the stage name of the current region."""
+    if not ENABLED:
+        return _DISABLED
+    return _Stage(name)
+
+
+def count(name):
+    """Counts a call of name for the current region."""
+    if ENABLED:
+        counts = _record()["counts"]
+        counts[name] = counts.get(name, 0) + 1
+
+
+@contextmanager
+def region(name):
+    """Attributes the stages and counts inside the block to the region name."""
+    global _region
+    previous, _region = _region, name
+    try:
+        yield
+    finally:
+        _region = previous
+
+
+def pop(name):
+    """Removes and returns the record of a region, for instance to send it from a worker process."""
+    return _records.pop(name, None)
+
+
+def merge(name, record):
+    """Adds a record returned by pop to the region name."""
+    if record is None:
+        return
+    target = _records.setdefault(name, {"stages": {}, "counts": {}})
+    for stage_name, (calls, seconds) in record["stages"].items():
+        total = target["stages"].setdefault(stage_name, [0, 0.0])
+        total[0] += calls
+        total[1] += seconds
+    for count_name, calls in record["counts"].items():
+        target["counts"][count_name] = target["counts"].get(count_name, 0) + calls
+
+
+def reset():
+    _records.clear()
+
+
+def dump(file_name = PROFILE_FILE):
+    """
+    Writes {region: {"stages": {stage: {"calls", "seconds"}}, "counts": {name: calls}}} as json.
+    """
+    output = {}
+    for name, record in _records.items():
+        output[name] = {"stages": {i: {"calls": calls, "seconds": round(seconds, 6)} for i, (calls, seconds) in record["stages"].items()},
+                        "counts": dict(record["counts"])}
+    with open(file_name, "w") as profile_file:
+        json.dump(output, profile_file, indent = 1)
@@ -3,6 +3,7 @@ import datetime
 from requests import get
 from pytz import timezone
 import csv
+import os
 
 my_date = datetime.datetime.now(timezone('Etc/GMT+5'))
 current_date = my_date.date()
@@ -14,13 +15,21 @@ current_date_str = my_date.date().strftime('%d-%b-%y')
 
 
 mapping = {"Sindh": 2, "Punjab": 1, "KP": 3, "Islamabad":0, "Balochistan": 4, "GB": 5, "AJK":6}
+DATE_FORMAT = '%d-%b-%y'
+CSV_FILE = './pakistan_data/pakistan_data.csv'
 
-def scrap_data():
+def scrap_data(url = 'https://www.geo.tv/', timeout = 30):
     """to scrap current data"""
-    url = 'https://www.geo.tv/'
-    response = get(url)
+    response = get(url, timeout = timeout)
+    response.raise_for_status()
+    return parse_banner(response.text)
 
-    html_soup = BeautifulSoup(response.text, 'html.parser')
+def parse_banner(html):
+    """
+    :param html: the page with the coronavirus banner.
+    :return: the cumulative cases of every province, in the order of mapping.
+    """
+    html_soup = BeautifulSoup(html, 'html.parser')
 
     corona_banner = html_soup.find('div', class_='coronavirus_banner')
     corona_banner = corona_banner.find_all('ul')
@@ -35,30 +44,56 @@ def scrap_data():
                 data[mapping[name]] = number
     return data
 
-def write_to_csv(data):
-    file_name = './pakistan_data/pakistan_data.csv'
-    with open(file_name, newline='', mode= 'r') as csvfile:
-        spamreader = csv.reader(csvfile, delimiter=',', quotechar='|')
-        rows = []
-        for row in spamreader:
-            rows.append(row)
-
-    last_reading = rows[-1]
-    last_date = (datetime.datetime.strptime(last_reading[0], '%d-%b-%y'))
-    last_date = last_date.date()
-
-    if last_date == current_date:
-        rows[-1] = [current_date.strftime('%d-%b-%y')] + data
+def read_last_row(file_name):
+    """
+    :return: the offset at which the last row of the csv file starts and the row, reading only the end of the file.
+    """
+    with open(file_name, mode = 'rb') as csvfile:
+        end = csvfile.seek(0, os.SEEK_END)
+        block = 256
+        while True:
+            start = max(end - block, 0)
+            csvfile.seek(start)
+            tail = csvfile.read(end - start)
+            lines = tail.rstrip(b'\r\n').split(b'\n')
+            if len(lines) > 1 or start == 0:
+                break
+            block *= 2
+    last_line = lines[-1]
+    offset = start + len(tail.rstrip(b'\r\n')) - len(last_line)
+    return offset, next(csv.reader([last_line.decode().strip()], delimiter=',', quotechar='|'))
+
+def write_to_csv(data, file_name = CSV_FILE, date = None):
+    """
+    :param data: the cumulative cases of every province on date.
+    :param file_name: the csv file to update.
+    :param date: the date of data, today in Pakistan by default.
+    :return: the rows written from the offset of the last row on.
+
+    Only the tail of the file is touched. The last row is replaced when it has the same date and data older than the
+    last row is ignored. Days missed since the last row are left out, the banner only shows the current cases so they
+    cannot be fetched, and csv_to_txt puts the cases reported since the last row on date.
+    """
+    if date is None:
+        date = current_date
+    offset, last_reading = read_last_row(file_name)
+    last_date = datetime.datetime.strptime(last_reading[0], DATE_FORMAT).date()
+
+    if date < last_date:
+        return []
+    if date == last_date:
+        rows = [[date.strftime(DATE_FORMAT)] + list(data)]
     else:
-        assert (abs(current_date - last_date).days) == 1
-        rows.append( [current_date.strftime('%d-%b-%y')] + data)
-
+        #the last row is rewritten as it was, so the new row starts on a line of its own
+        rows = [last_reading, [date.strftime(DATE_FORMAT)] + list(data)]
 
-    file_name = './pakistan_data/pakistan_data.csv'
-    with open(file_name, newline='', mode='w') as csvfile:
+    with open(file_name, newline='', mode='r+') as csvfile:
+        csvfile.seek(offset)
+        csvfile.truncate()
         spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|')
         for row in rows:
             spamwriter.writerow(row)
+    return rows
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+"""
+SEIR model of the SIER Model notebook. Every parameter (birth_rate, death_rate, beta, alpha, gamma, N) can be a float,
+an array with one value per ensemble member, or a function f(t) returning either, so a whole ensemble of parameter sets
+and time-varying interventions are integrated together. States are arrays of shape (n_ensembles, 4) holding S, E, I, R,
+an optional fifth column accumulates the cases that became infectious.
+"""
+import numpy as np
+from scipy import integrate, sparse
+
+
+def value_at(parameter, t):
+    """The value of a parameter at time t, calling it if it is a function of t."""
+    if callable(parameter):
+        return np.asarray(parameter(t), dtype = float)
+    return np.asarray(parameter, dtype = float)
+
+
+def piecewise_constant(change_points, values):
+    """
+    :param change_points: increasing times at which the parameter changes.
+    :param values: an array whose last axis has len(change_points) + 1 values, values[..., i] holds between
+    change_points[i - 1] and change_points[i]. Leading axes are the ensemble.
+    :return: a function f(t) returning values[..., i] for the interval containing t.
+    """
+    change_points = np.asarray(change_points, dtype = float)
+    values = np.asarray(values, dtype = float)
+    assert values.shape[-1] == len(change_points) + 1
+
+    def parameter(t):
+        return values[..., np.searchsorted(change_points, t, side = 'right')]
+    return parameter
+
+
+def seir_derivative(current_state, current_t, arguments):
+    """
+    :param current_state: an array of shape (..., 4) or (..., 5), denoting S, E, I, R (and the cumulative cases).
+    :param current_t: the time.
+    :param arguments: tuple of 6 parameters, denoting birth_rate, death_rate, beta, alpha, gamma, N
+    :return: the rate of change of current_state.
+    """
+    S, E, I, R = current_state[..., 0], current_state[..., 1], current_state[..., 2], current_state[..., 3]
+    birth_rate, death_rate, beta, alpha, gamma, N = (value_at(i, current_t) for i in arguments)
+
+    infections = beta * (I / N) * S
+    rates = [birth_rate - (death_rate * S) - infections,
+             infections - (death_rate + alpha) * E,
+             (alpha * E) - ((gamma + death_rate) * I),
+             (gamma * I) - (death_rate * R)]
+    if current_state.shape[-1] == 5:
+        rates.append(alpha * E)
+    return np.stack(np.broadcast_arrays(*rates), axis = -1)
+
+
+def euler_step(current_state, current_t, delta_t, arguments):
+    """
+    The Euler step of the notebook's get_next_state, for a whole ensemble. As in the notebook, the parameters are taken
+    at the end of the step, current_t + delta_t, the time of the state it returns.
+    """
+    return current_state + delta_t * seir_derivative(current_state, current_t + delta_t, arguments)
+
+
+def rk4_step(current_state, current_t, delta_t, arguments):
+    """Classic fourth order Runge-Kutta step."""
+    k1 = seir_derivative(current_state, current_t, arguments)
+    k2 = seir_derivative(current_state + (delta_t / 2) * k1, current_t + delta_t / 2, arguments)
+    k3 = seir_derivative(current_state + (delta_t / 2) * k2, current_t + delta_t / 2, arguments)
+    k4 = seir_derivative(current_state + delta_t * k3, current_t + delta_t, arguments)
+    return current_state + (delta_t / 6) * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+STEPS = {"euler": euler_step, "rk4": rk4_step}
+
+
+def integrate_seir(start_state, parameters, t_start = 0, t_end = 100, delta_t = 1, method = "rk4", rtol = 1e-6, atol = 1e-6):
+    """
+    :param start_state: an array of shape (n_ensembles, 4) or (n_ensembles, 5), or a single state of length 4 or 5.
+    :param parameters: tuple of 6 parameters, denoting birth_rate, death_rate, beta, alpha, gamma, N
+    :param t_start, t_end, delta_t: the states are returned at np.arange(t_start, t_end, delta_t).
+    :param method: "euler" or "rk4" for fixed steps of delta_t, or any method of scipy.integrate.solve_ivp such as
+    "RK45" or "LSODA" for adaptive steps. The implicit methods are told that the members of the ensemble are
+    independent, so their jacobian stays block diagonal.
+    :param rtol, atol: tolerances of the adaptive methods.
+    :return: all_t, an array of the times, and states, an array of shape (len(all_t),) + start_state.shape.
+    """
+    current_state = np.asarray(start_state, dtype = float)
+    all_t = np.arange(t_start, t_end, delta_t)
+
+    if method in STEPS:
+        step = STEPS[method]
+        states = np.empty((len(all_t),) + current_state.shape)
+        states[0] = current_state
+        for i in range(1, len(all_t)):
+            current_state = step(current_state, all_t[i - 1], delta_t, parameters)
+            states[i] = current_state
+        return all_t, states
+
+    shape = current_state.shape
+    def rate_of_change(current_t, flat_state):
+        return seir_derivative(flat_state.reshape(shape), current_t, parameters).ravel()
+
+    columns = shape[-1]
+    options = {}
+    if method == "LSODA":
+        options = {"lband": columns - 1, "uband": columns - 1}
+    elif method in ("BDF", "Radau"):
+        options = {"jac_sparsity": sparse.block_diag([np.ones((columns, columns))] * (current_state.size // columns))}
+
+    solution = integrate.solve_ivp(rate_of_change, (all_t[0], all_t[-1]), current_state.ravel(), method = method,
+                                   t_eval = all_t, rtol = rtol, atol = atol, **options)
+    if not solution.success:
+        raise RuntimeError(solution.message)
+    return all_t, np.moveaxis(solution.y, -1, 0).reshape((len(all_t),) + shape)
+
+
+def plot_SEIR(all_t, states, plot_surface = None):
+    """
+    :param all_t, states: outputs of integrate_seir for a single state, or one member of an ensemble.
+    :param plot_surface: the surface at which to produce plots, a new figure by default.
+    """
+    import matplotlib.pyplot as plt
+
+    if plot_surface is None:
+        f, plot_surface = plt.subplots(1, 1, figsize=(10, 4))
+    plot_surface.plot(all_t, states[:, 0], 'b', alpha=0.7, linewidth=2, label='Susceptible')
+    plot_surface.plot(all_t, states[:, 1], 'y', alpha=0.7, linewidth=2, label='Exposed')
+    plot_surface.plot(all_t, states[:, 2], 'r', alpha=0.7, linewidth=2, label='Infected')
+    plot_surface.plot(all_t, states[:, 3], 'g', alpha=0.7, linewidth=2, label='Recovered')
+    plot_surface.set_xlabel('Time (days)')
+    plot_surface.legend(borderpad=2.0)
+    return plot_surface
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
+    #the scenarios of the notebook, run as one ensemble
+    N = 1000
+    beta = piecewise_constant([50], [[1.7, 1.7], [4, 1]]) #rate of infection per infected person
+    alpha = np.array([1 / 2, 1 / 14]) #incubation rate
+    gamma = 1 / 14 #time to recover
+    parameters = (0, 0, beta, alpha, gamma, N)
+    start_state = np.array([[N - 1, 1, 0, 0]] * 2)
+
+    all_t, states = integrate_seir(start_state, parameters, method = "euler")
+    for i in range(len(start_state)):
+        plot_SEIR(all_t, states[:, i])
+    plt.show()
@@ -0,0 +1,165 @@
+import numpy as np
+from scipy import stats
+import csv
+import time
+from concurrent.futures import ProcessPoolExecutor
+import incidence_store
+import seir
+
+POPULATIONS = {"Pakistan": 207.8e6, "ICT": 2.0e6, "Punjab": 110.0e6, "Sindh": 47.9e6, "KPK": 40.5e6,
+               "Balochistan": 12.3e6, "GB": 1.5e6, "AJK": 4.0e6} #2017 census, KPK with the merged districts
+
+ALPHA = 1 / 5.2 #incubation rate, mean incubation period of 5.2 days (Li et al. 2020), not identifiable from cases alone
+
+#bounds of the uniform priors of the log of every fitted parameter
+BETA_BOUNDS = (np.log(0.02), np.log(3))
+ALPHA_BOUNDS = (np.log(ALPHA), np.log(ALPHA)) #fixed, a free alpha sat on its lower bound for every region
+GAMMA_BOUNDS = (np.log(1 / 21), np.log(1 / 3)) #recovery rate
+EXPOSED_BOUNDS = (np.log(1), np.log(1e4)) #exposed on the first day
+DISPERSION_BOUNDS = (np.log(0.5), np.log(100)) #size of the negative binomial of the reported cases
+BOUND_TOLERANCE = 0.01 #fits whose log is this close to a bound of their prior are flagged by write_fits
+
+
+def prior_bounds(segments):
+    """
+    :param segments: the number of intervals of beta.
+    :return: an array of shape (segments + 4, 2) with the bounds of the log of every fitted parameter, in the order
+    of log_likelihoods.
+    """
+    return np.array([BETA_BOUNDS] * segments + [ALPHA_BOUNDS, GAMMA_BOUNDS, EXPOSED_BOUNDS, DISPERSION_BOUNDS])
+
+
+def log_likelihoods(incidence, population, change_days, log_parameters, steps_per_day = 2):
+    """
+    :param incidence: an array of the daily incident cases of a region, from the first day of its series.
+    :param population: the population N of the region.
+    :param change_days: the days at which beta changes, beta is constant in between.
+    :param log_parameters: an array of shape (n_candidates, len(change_days) + 5) holding the log of beta for every
+    interval, alpha, gamma, the exposed on day 0 and the negative binomial size.
+    :param steps_per_day: number of RK4 steps per day.
+    :return: an ndarray of shape (n_candidates,), the log likelihood of the incidence under every candidate.
+
+    All the candidates are integrated together as one ensemble. The cases of day s are the new infectious cases
+    between day s and s + 1, days with negative counts are skipped.
+    """
+    incidence = np.asarray(incidence, dtype = float)
+    parameters = np.exp(log_parameters)
+    segments = len(change_days) + 1
+    beta = seir.piecewise_constant(change_days, parameters[:, :segments])
+    alpha, gamma, exposed, dispersion = parameters[:, segments:].T
+
+    start_state = np.zeros((len(parameters), 5))
+    start_state[:, 0] = population - exposed
+    start_state[:, 1] = exposed
+    all_t, states = seir.integrate_seir(start_state, (0, 0, beta, alpha, gamma, population),
+                                       t_end = len(incidence) + 1, delta_t = 1 / steps_per_day)
+    cases = np.diff(states[::steps_per_day, :, 4], axis = 0).T #(n_candidates, days)
+
+    mean = np.maximum(cases, 1e-9)
+    log_likelihood = stats.nbinom.logpmf(incidence, dispersion[:, np.newaxis], dispersion[:, np.newaxis] / (dispersion[:, np.newaxis] + mean))
+    return np.sum(log_likelihood[:, incidence >= 0], axis = -1)
+
+
+def calibrate_region(incidence, population, change_days, batch_size = 2000, iterations = 15, elite_fraction = 0.1,
+                     steps_per_day = 2, seed = 0):
+    """
+    :param incidence: an array of the daily incident cases of a region, from the first day of its series.
+    :param population: the population N of the region.
+    :param change_days: the days at which beta changes, beta is constant in between.
+    :param batch_size: the number of candidates evaluated in one integration.
+    :param iterations: the number of batches.
+    :param elite_fraction: the fraction of the best candidates of a batch the next batch is drawn around.
+    :param seed: seed of the random number generator.
+    :return: the best log likelihood and the parameters reaching it, as an array of beta for every interval, alpha,
+    gamma, the exposed on day 0 and the negative binomial size.
+
+    Cross entropy search over the log of the parameters. The first batch is drawn from the uniform priors, every
+    later batch from a normal fitted to the elite of the batch before, clipped to the priors.
+    """
+    rng = np.random.default_rng(seed)
+    bounds = prior_bounds(len(change_days) + 1)
+    n_elite = max(int(batch_size * elite_fraction), 2)
+
+    candidates = rng.uniform(bounds[:, 0], bounds[:, 1], size = (batch_size, len(bounds)))
+    best, best_log_likelihood = None, -np.inf
+    for i in range(iterations):
+        log_likelihood = log_likelihoods(incidence, population, change_days, candidates, steps_per_day = steps_per_day)
+        log_likelihood = np.where(np.isnan(log_likelihood), -np.inf, log_likelihood)
+        elite = candidates[np.argsort(log_likelihood)[-n_elite:]]
+        if log_likelihood.max() > best_log_likelihood:
+            best, best_log_likelihood = candidates[np.argmax(log_likelihood)], log_likelihood.max()
+
+        candidates = rng.normal(elite.mean(axis = 0), elite.std(axis = 0) + 1e-3, size = candidates.shape)
+        candidates = np.clip(candidates, bounds[:, 0], bounds[:, 1])
+        candidates[0] = best #the best candidate so far is always kept
+    return best_log_likelihood, np.exp(best)
+
+
+def calibrate(regions, incidence, starts, change_every = 21, workers = None, **options):
+    """
+    :param regions: names of the regions, used to look up POPULATIONS.
+    :param incidence: an array of shape (regions, days) of incident cases.
+    :param starts: the first day of the series of every region.
+    :param change_every: beta changes every change_every days after the start of every region.
+    :param workers: number of worker processes, None uses every core and 1 runs in this process.
+    :param options: passed to calibrate_region.
+    :return: a list with (log likelihood, change_days, parameters) for every region.
+    """
+    args = []
+    for i in range(len(regions)):
+        series = np.array(incidence[i, starts[i]:])
+        change_days = list(range(change_every, len(series), change_every))
+        args.append((series, POPULATIONS[regions[i]], change_days))
+
+    if workers == 1:
+        fits = [calibrate_region(*i, **options) for i in args]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(calibrate_region, *i, **options) for i in args]
+            fits = [i.result() for i in futures]
+    return [(log_likelihood, change_days, parameters) for (log_likelihood, parameters), (_, _, change_days) in zip(fits, args)]
+
+
+def write_fits(file_name, regions, fits):
+    """
+    :param file_name: the csv file to write.
+    :param regions: the names of the calibrated regions.
+    :param fits: the output of calibrate.
+    :return: None
+
+    One row per interval of beta of every region, with R_0 = beta / gamma of the interval. The last column names the
+    parameters of the row that are within BOUND_TOLERANCE of a bound of their prior, in log, so the data did not
+    pin them down. Fixed parameters are not flagged.
+    """
+    with open(file_name, newline='', mode='w') as csvfile:
+        spamwriter = csv.writer(csvfile, delimiter=',', quotechar='|')
+        spamwriter.writerow(["Region", "Log likelihood", "From day", "Beta", "R_0", "Alpha", "Gamma", "Exposed on day 0", "Dispersion", "At a bound"])
+        for region, (log_likelihood, change_days, parameters) in zip(regions, fits):
+            segments = len(change_days) + 1
+            alpha, gamma, exposed, dispersion = parameters[segments:]
+            bounds = prior_bounds(segments)
+            at_bound = (bounds[:, 1] > bounds[:, 0]) & np.any(np.abs(np.log(parameters)[:, np.newaxis] - bounds) < BOUND_TOLERANCE, axis = -1)
+            for j, from_day in enumerate([0] + change_days):
+                flagged = [name for name, k in (("Beta", j), ("Gamma", segments + 1), ("Exposed on day 0", segments + 2),
+                                                 ("Dispersion", segments + 3)) if at_bound[k]]
+                spamwriter.writerow([region, round(log_likelihood, 1), from_day, round(parameters[j], 3),
+                                     round(parameters[j] / gamma, 2), round(alpha, 3), round(gamma, 3),
+                                     round(exposed), round(dispersion, 2), " ".join(flagged)])
+
+
+if __name__ == "__main__":
+    CHANGE_EVERY = 21 #days between changes of beta
+    BATCH_SIZE = 2000
+    ITERATIONS = 15
+    WORKERS = None
+
+    regions, dates, incidence, starts = incidence_store.load_store()
+    start = time.perf_counter()
+    fits = calibrate(regions, incidence, starts, change_every = CHANGE_EVERY, workers = WORKERS,
+                     batch_size = BATCH_SIZE, iterations = ITERATIONS)
+    write_fits("seir_fits.csv", regions, fits)
+    print(f"Saved seir_fits.csv, {len(regions)} regions calibrated in {time.perf_counter() - start:.1f}s")
+    for region, (log_likelihood, change_days, parameters) in zip(regions, fits):
+        segments = len(change_days) + 1
+        print(f"{region}: log likelihood = {log_likelihood:.1f}, R_0 = "
+              f"{', '.join(f'{i:.2f}' for i in parameters[:segments] / parameters[segments + 1])}")
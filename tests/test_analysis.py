@@ -0,0 +1,167 @@
+"""
+Tests of the vectorized estimation of analysis.py against the scalar lambda_t and estimate_R_t and the closure of the
+infection profile they were written for, on a short series and for every day with a full window.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+from scipy import stats
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pakistan_data"))
+import analysis
+
+MEAN_SI = 4
+SD_SI = 5
+WINDOW = 4
+A = 1
+B = 5
+
+
+def baseline_infection_profile(mean, std_deviation):
+    """infection_profile before the kernels, one set of gamma cdfs per day, kept in a dict."""
+    beta = mean / (std_deviation ** 2)
+    alpha = mean * beta
+
+    probs = {}
+    def prob(s):
+        s += 1
+        if s not in probs:
+            probs[s] = (s * stats.gamma.cdf(s, a = alpha, scale = 1/beta)) + ((s - 2) * stats.gamma.cdf(s - 2, a = alpha, scale = 1/beta)) - \
+                       (2 * (s - 1) * stats.gamma.cdf(s - 1, a = alpha, scale = 1/beta)) + \
+                       ((alpha * 1/beta) * (2 * stats.gamma.cdf(s - 1, a = alpha + 1, scale = 1/beta) - stats.gamma.cdf(s - 2, a = alpha + 1, scale = 1/beta) -
+                                            stats.gamma.cdf(s, a = alpha + 1, scale = 1/beta)))
+        return probs[s]
+    return prob
+
+
+def series(days = 40, seed = 1):
+    rng = np.random.default_rng(seed)
+    return rng.poisson(30 + 20 * np.sin(np.arange(days) / 6)).astype(float)
+
+
+def scalar_posterior(t, window, incidence, w):
+    """alpha and beta of the gamma posterior of R_t, summed day by day as estimate_R_t does."""
+    alpha = A + sum(incidence[s] for s in range(t - window, t))
+    beta = (1/B) + sum(analysis.lambda_t(s, incidence, w) for s in range(t - window, t))
+    return alpha, beta
+
+
+def scalar_forecast(c, h, window, incidence, w):
+    """n, p and mean of the forecast of day c + h - 1 from the days before c, the unknown days taken at their means."""
+    alpha, beta = scalar_posterior(c, window, incidence, w)
+    known = list(incidence[:c])
+    for day in range(c, c + h):
+        lambda_day = analysis.lambda_t(day, known, w)
+        known.append(alpha / beta * lambda_day)
+    return alpha, beta / (beta + lambda_day), known[-1]
+
+
+class ExpectedDraws:
+    """Stands in for a numpy.random.Generator, every draw is the mean of its distribution, counts are rounded."""
+
+    def gamma(self, shape, scale = 1.0, size = None):
+        return np.array(np.broadcast_to(np.multiply(shape, scale), size), dtype = float)
+
+    def poisson(self, lam):
+        return np.round(lam)
+
+
+class VectorizedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.incidence = series()
+        self.T = len(self.incidence)
+        self.w = baseline_infection_profile(MEAN_SI, SD_SI)
+        self.kernel, discarded = analysis.truncated_infection_profile_kernel(MEAN_SI, SD_SI)
+
+    def test_kernel_matches_the_closure(self):
+        K = 60
+        expected = [baseline_infection_profile(MEAN_SI, SD_SI)(s) for s in range(K + 1)]
+        np.testing.assert_allclose(analysis.infection_profile_kernel(MEAN_SI, SD_SI, K), expected, rtol = 1e-9, atol = 1e-15)
+        np.testing.assert_allclose(analysis.kernel_array(analysis.infection_profile(MEAN_SI, SD_SI), K), expected, rtol = 1e-9, atol = 1e-15)
+        np.testing.assert_allclose(self.kernel[:K + 1], expected, rtol = 1e-9, atol = 1e-15)
+
+        bank = analysis.infection_profile_kernel([3, 8.4], [1.5, 3.8], K)
+        for row, (mean, std_deviation) in zip(bank, [(3, 1.5), (8.4, 3.8)]):
+            w = baseline_infection_profile(mean, std_deviation)
+            np.testing.assert_allclose(row, [w(s) for s in range(K + 1)], rtol = 1e-9, atol = 1e-15)
+
+    def test_lambda_series_matches_lambda_t(self):
+        expected = [analysis.lambda_t(t, self.incidence, self.w) for t in range(self.T + 1)]
+        np.testing.assert_allclose(analysis.lambda_series(self.incidence, self.w), expected, rtol = 1e-12)
+        np.testing.assert_allclose(analysis.lambda_series(self.incidence, self.kernel), expected, rtol = 1e-9)
+
+        batch = np.stack((self.incidence, series(seed = 2)))
+        lambdas = analysis.lambda_series(batch, self.kernel) #transformed, not convolved directly
+        for i in range(len(batch)):
+            np.testing.assert_allclose(lambdas[i], [analysis.lambda_t(t, batch[i], self.w) for t in range(self.T + 1)], rtol = 1e-9)
+
+    def test_posterior_matches_the_window_sums(self):
+        alpha, beta = analysis.posterior_R_t_parameters(self.incidence, self.kernel, WINDOW, a = A, b = B)
+        for t in range(WINDOW, self.T + 1):
+            np.testing.assert_allclose((alpha[t], beta[t]), scalar_posterior(t, WINDOW, self.incidence, self.w), rtol = 1e-9)
+
+    def test_estimate_R_t_series_matches_estimate_R_t(self):
+        means, intervals = analysis.estimate_R_t_series(self.incidence, self.kernel, WINDOW, a = A, b = B)
+        for t in range(WINDOW, self.T + 1):
+            quantiles, mean = analysis.estimate_R_t(t, WINDOW, self.incidence, self.w, a = A, b = B)
+            self.assertAlmostEqual(means[t], mean, delta = 1e-9 * mean)
+            np.testing.assert_allclose(intervals[:, t], quantiles, rtol = 1e-9)
+
+    def test_forecasts_match_the_scalar_forecasts(self):
+        horizons = 5
+        n, p, means = analysis.forecast_distributions(self.incidence, self.kernel, WINDOW, horizons = horizons, a = A, b = B)
+        for c in range(WINDOW, self.T):
+            for h in range(1, horizons + 1):
+                if c + h - 1 >= self.T:
+                    self.assertTrue(np.isnan(means[h - 1, c - WINDOW]))
+                    continue
+                expected = scalar_forecast(c, h, WINDOW, self.incidence, self.w)
+                np.testing.assert_allclose((n[h - 1, c - WINDOW], p[h - 1, c - WINDOW], means[h - 1, c - WINDOW]), expected, rtol = 1e-9)
+
+    def test_backtest_matches_the_scalar_scores(self):
+        horizons, level = 3, 0.9
+        coverage, mae, log_score = analysis.backtest_forecasts(self.incidence, self.kernel, WINDOW, horizons = horizons, a = A, b = B, level = level)
+        for h in range(1, horizons + 1):
+            inside, errors, log_probabilities = [], [], []
+            for c in range(WINDOW, self.T - h + 1):
+                n, p, mean = scalar_forecast(c, h, WINDOW, self.incidence, self.w)
+                observed = self.incidence[c + h - 1]
+                inside.append(stats.nbinom.ppf((1 - level) / 2, n, p) <= observed <= stats.nbinom.ppf((1 + level) / 2, n, p))
+                errors.append(abs(observed - mean))
+                log_probabilities.append(stats.nbinom.logpmf(observed, n, p))
+            self.assertAlmostEqual(coverage[h - 1], np.mean(inside))
+            self.assertAlmostEqual(mae[h - 1], np.mean(errors), delta = 1e-9 * np.mean(errors))
+            self.assertAlmostEqual(log_score[h - 1], np.mean(log_probabilities), delta = 1e-9 * abs(np.mean(log_probabilities)))
+
+    def test_projection_matches_the_scalar_recursion(self):
+        horizon = 6
+        means, intervals = analysis.project_incidence(self.incidence, self.kernel, WINDOW, horizon = horizon, n_paths = 4,
+                                                      quantiles = (0.1, 0.9), a = A, b = B, rng = ExpectedDraws())
+        alpha, beta = scalar_posterior(self.T, WINDOW, self.incidence, self.w)
+        known = list(self.incidence)
+        for t in range(self.T, self.T + horizon):
+            known.append(np.round(alpha / beta * analysis.lambda_t(t, known, self.w)))
+        np.testing.assert_array_equal(means, known[self.T:])
+        np.testing.assert_array_equal(intervals, [known[self.T:]] * 2)
+
+    def test_select_window_matches_the_scalar_scores(self):
+        windows = [1, 3, 7]
+        start_day = 10
+        best, scores = analysis.select_window(self.incidence, self.kernel, windows, start_day = start_day, a = A, b = B)
+        for i, window in enumerate(windows):
+            expected = 0
+            for t in range(start_day, self.T):
+                alpha, beta = scalar_posterior(t, window, self.incidence, self.w)
+                lambda_day = analysis.lambda_t(t, self.incidence, self.w)
+                expected += stats.nbinom.logpmf(self.incidence[t], alpha, beta / (beta + lambda_day))
+            self.assertAlmostEqual(scores[i], expected, delta = 1e-9 * abs(expected))
+        self.assertEqual(best, windows[int(np.argmax(scores))])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+"""
+Tests of the days missing from the csv of cumulative cases.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pakistan_data"))
+import csv_to_txt
+
+
+class FillMissingDatesTest(unittest.TestCase):
+
+    def test_missed_days_report_nothing_until_the_batch(self):
+        dates = ["10-Mar-20", "11-Mar-20", "14-Mar-20"]
+        cumulative = np.array([[1, 2], [3, 4], [9, 10]])
+        filled_dates, filled = csv_to_txt.fill_missing_dates(dates, cumulative)
+        self.assertEqual(filled_dates, ["10-Mar-20", "11-Mar-20", "12-Mar-20", "13-Mar-20", "14-Mar-20"])
+        np.testing.assert_array_equal(np.diff(filled, axis = 0, prepend = 0), [[1, 2], [2, 2], [0, 0], [0, 0], [6, 6]])
+
+    def test_consecutive_dates_are_unchanged(self):
+        dates = ["10-Mar-20", "11-Mar-20"]
+        cumulative = np.array([[1, 2], [3, 4]])
+        self.assertEqual(csv_to_txt.fill_missing_dates(dates, cumulative), (dates, cumulative))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Tests of fetcher.update against a stand-in for the news site served on localhost, so no request leaves the machine.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import asyncio
+import datetime
+import tempfile
+import threading
+import unittest
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pakistan_data"))
+import fetcher
+import scrap_data_to_csv
+
+FIXTURE = os.path.join(ROOT, "tests", "fixtures", "banner.html")
+BANNER_CASES = [120, 2300, 1500, 800, 250, 210, 40] #the provinces of the fixture, in the order of the csv
+HEADER = "Date,ICT,Punjab,Sindh,KPK,Balochistan,GB,AJK\n"
+LAST_ROW = "20-May-20,100,2000,1400,700,200,200,30\n"
+ETAG = '"banner-1"'
+
+
+class StandInServer:
+    """
+    Serves the fixture banner on a free port of localhost from a thread with its own event loop. It answers 304 to a
+    matching If-None-Match, and answers the first requests with the given error statuses.
+    """
+
+    def __init__(self, failures = ()):
+        with open(FIXTURE) as fixture:
+            self.page = fixture.read()
+        self.failures = list(failures)
+        self.requests = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+
+    async def banner(self, request):
+        self.requests.append(dict(request.headers))
+        if self.failures:
+            return web.Response(status = self.failures.pop(0))
+        if request.headers.get("If-None-Match") == ETAG:
+            return web.Response(status = 304)
+        return web.Response(text = self.page, content_type = "text/html", headers = {"ETag": ETAG})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/", self.banner)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        return self.runner.addresses[0][1]
+
+    def __enter__(self):
+        self.thread.start()
+        port = asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+        self.url = f"http://127.0.0.1:{port}/"
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.csv_file = os.path.join(self.directory.name, "pakistan_data.csv")
+        self.cache_file = os.path.join(self.directory.name, "fetch_cache.json")
+        with open(self.csv_file, "w") as csvfile:
+            csvfile.write(HEADER + LAST_ROW)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def update(self, server, date, **options):
+        sources = {"geo": (server.url, scrap_data_to_csv.parse_banner)}
+        return fetcher.update(self.csv_file, sources, self.cache_file, date, backoff = 0, **options)
+
+    def read_csv(self):
+        with open(self.csv_file) as csvfile:
+            return csvfile.read()
+
+    def test_writes_the_banner_then_sends_the_etag(self):
+        with StandInServer() as server:
+            rows = self.update(server, datetime.date(2020, 5, 21))
+            self.assertEqual(rows[-1], ["21-May-20"] + BANNER_CASES)
+            self.assertEqual(self.read_csv(), HEADER + LAST_ROW + "21-May-20," + ",".join(map(str, BANNER_CASES)) + "\n")
+
+            self.assertEqual(self.update(server, datetime.date(2020, 5, 22)), [])
+            self.assertEqual(server.requests[-1].get("If-None-Match"), ETAG)
+        self.assertNotIn("22-May-20", self.read_csv())
+
+    def test_missed_days_are_left_out(self):
+        with StandInServer() as server:
+            rows = self.update(server, datetime.date(2020, 5, 24))
+        lines = self.read_csv().splitlines()
+        self.assertEqual([line.split(",")[0] for line in lines[1:]], ["20-May-20", "24-May-20"])
+        self.assertEqual(rows[-1], ["24-May-20"] + BANNER_CASES)
+
+    def test_server_errors_are_retried(self):
+        with StandInServer(failures = [503, 502]) as server:
+            rows = self.update(server, datetime.date(2020, 5, 21), retries = 2)
+            self.assertEqual(len(server.requests), 3)
+        self.assertEqual(rows[-1], ["21-May-20"] + BANNER_CASES)
+
+    def test_client_errors_are_not_retried(self):
+        with StandInServer(failures = [404]) as server:
+            rows = self.update(server, datetime.date(2020, 5, 21), retries = 2)
+            self.assertEqual(len(server.requests), 1)
+        self.assertEqual(rows, [])
+        self.assertEqual(self.read_csv(), HEADER + LAST_ROW)
+
+
+if __name__ == "__main__":
+    unittest.main()
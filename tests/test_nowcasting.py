@@ -0,0 +1,54 @@
+"""
+Tests of the nowcast of onsets from reports delayed by a known distribution.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pakistan_data"))
+import nowcasting
+
+DAYS = 80
+
+
+def synthetic_onsets(delay):
+    """A wave of onsets from day -D to day DAYS - 1, and the reports expected from it on days 0 to DAYS - 1."""
+    D = len(delay) - 1
+    t = np.arange(-D, DAYS)
+    onsets = 2000 * np.exp(-0.5 * ((t - 50) / 15) ** 2) + 50
+    convolve, correlate = nowcasting.delay_operators(delay, DAYS)
+    return onsets[D:], convolve(onsets)
+
+
+class NowcastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.delay = nowcasting.delay_distribution()
+        self.onsets, self.reports = synthetic_onsets(self.delay)
+
+    def test_deconvolve_recovers_the_onsets(self):
+        onsets, reported, expected = nowcasting.deconvolve(self.reports, self.delay)
+        kept = reported >= nowcasting.MIN_REPORTED
+        self.assertFalse(kept[-1]) #the last onsets are mostly unreported
+        self.assertGreater(np.sum(kept), DAYS - 7)
+        np.testing.assert_allclose(onsets[kept], self.onsets[kept], rtol = 0.05)
+        np.testing.assert_allclose(expected, self.reports, rtol = 0.1)
+
+    def test_nowcast_intervals_cover_the_onsets(self):
+        rng = np.random.default_rng(1)
+        reports = rng.poisson(np.stack((self.reports, self.reports / 10))) #two regions nowcast together
+        onsets, intervals, reported = nowcasting.nowcast(reports, self.delay, n_bootstrap = 200, rng = np.random.default_rng(2))
+        kept = reported >= nowcasting.MIN_REPORTED
+        truth = np.stack((self.onsets, self.onsets / 10))
+        self.assertEqual(intervals.shape, (2,) + reports.shape)
+        inside = (intervals[0] <= truth) & (truth <= intervals[1])
+        self.assertGreater(np.mean(inside[:, kept]), 0.9)
+        np.testing.assert_allclose(onsets[0, kept], truth[0, kept], rtol = 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
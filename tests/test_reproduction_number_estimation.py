@@ -0,0 +1,99 @@
+"""
+Tests of the vectorized simulations of cori_2013/reproduction_number_estimation.py against the scalar lambda_t and
+estimate_R_t and the closure of the infection profile. The random draws are replaced by their means, so every path is
+deterministic and the day by day loops they replaced can be followed exactly.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+from scipy import stats
+import matplotlib
+matplotlib.use("Agg")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "cori_2013"))
+import reproduction_number_estimation as cori
+
+
+def baseline_infection_profile(mean, std_deviation):
+    """infection_profile before the kernels, one set of gamma cdfs per day, kept in a dict."""
+    beta = mean / (std_deviation ** 2)
+    alpha = mean * beta
+
+    probs = {}
+    def prob(s):
+        s += 1
+        if s not in probs:
+            probs[s] = (s * stats.gamma.cdf(s, a = alpha, scale = 1/beta)) + ((s - 2) * stats.gamma.cdf(s - 2, a = alpha, scale = 1/beta)) - \
+                       (2 * (s - 1) * stats.gamma.cdf(s - 1, a = alpha, scale = 1/beta)) + \
+                       ((alpha * 1/beta) * (2 * stats.gamma.cdf(s - 1, a = alpha + 1, scale = 1/beta) - stats.gamma.cdf(s - 2, a = alpha + 1, scale = 1/beta) -
+                                            stats.gamma.cdf(s, a = alpha + 1, scale = 1/beta)))
+        return probs[s]
+    return prob
+
+
+class ExpectedDraws:
+    """Stands in for a numpy.random.Generator, every draw is the mean of its distribution, counts are rounded."""
+
+    def normal(self, loc = 0.0, scale = 1.0, size = None):
+        return np.array(np.broadcast_to(loc, size), dtype = float)
+
+    def gamma(self, shape, scale = 1.0, size = None):
+        return np.array(np.broadcast_to(np.multiply(shape, scale), size), dtype = float)
+
+    def poisson(self, lam):
+        return np.round(lam)
+
+
+class VectorizedTest(unittest.TestCase):
+
+    def test_series_match_the_scalar_estimates(self):
+        window = 3
+        incidence = np.random.default_rng(1).poisson(30 + 20 * np.sin(np.arange(30) / 5)).astype(float)
+        w = baseline_infection_profile(2.6, 1.5)
+        np.testing.assert_allclose(cori.lambda_series(incidence, w), [cori.lambda_t(t, incidence, w) for t in range(len(incidence) + 1)], rtol = 1e-12)
+
+        means, intervals = cori.estimate_R_t_series(incidence, w, window)
+        for t in range(window, len(incidence) + 1):
+            quantiles, mean = cori.estimate_R_t(t, window, incidence, w)
+            self.assertAlmostEqual(means[t], mean, delta = 1e-9 * mean)
+            np.testing.assert_allclose(intervals[:, t], quantiles, rtol = 1e-9)
+
+    def test_simulate_epidemics_matches_the_daily_loop(self):
+        T = 30
+        w = baseline_infection_profile(8.4, 3.8)
+        instant_R_t = 1.5 + 0.5 * np.sin(np.arange(T + 1) / 4) + np.array([[0], [0.3], [0.6]])
+        incidence = cori.simulate_epidemics(instant_R_t, w, T, 3, initial_incidence = 10, rng = ExpectedDraws())
+
+        for n in range(3):
+            expected = [10]
+            for t in range(1, T + 1):
+                expected.append(np.round(instant_R_t[n, t] * cori.lambda_t(t, expected, w)))
+            np.testing.assert_array_equal(incidence[n], expected)
+
+    def test_appendix_6_engine_matches_the_daily_loop(self):
+        T, window = 30, 2
+        days, incidence, means, starts, ends, min_day = cori.appendix_6_engine(T = T, N = 8, mean = 8.4, std_deviation = 3.8, window = window,
+                                                                              chunk_size = 3, rng = ExpectedDraws())
+        np.testing.assert_array_equal(days, np.arange(2, T + 1))
+
+        w = baseline_infection_profile(8.4, 3.8) #every serial interval is drawn at its mean
+        expected = [0, 10]
+        for day_num, t in enumerate(days):
+            expected.append(np.round(cori.prior_instant_R_t(t) * cori.lambda_t(t, expected, w)))
+            if t > window:
+                quantiles, mean = cori.estimate_R_t(t, window, expected, w)
+                self.assertAlmostEqual(means[day_num], mean, delta = 1e-9 * mean)
+            else:
+                self.assertTrue(np.isnan(means[day_num]))
+        np.testing.assert_array_equal(incidence, expected)
+        np.testing.assert_allclose(starts[:, days > window], np.broadcast_to(means[days > window], (3, np.sum(days > window))), rtol = 1e-9)
+        np.testing.assert_allclose(ends[:, days > window], np.broadcast_to(means[days > window], (3, np.sum(days > window))), rtol = 1e-9)
+        self.assertEqual(min_day, days[np.argmax(np.cumsum(incidence)[days] > 12)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+Tests of the Euler integration of seir.py against the loop of the SIER Model notebook.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pakistan_data"))
+import seir
+
+
+def get_next_state(current_state, current_t, delta_t, arguments):
+    """get_next_state of the notebook."""
+    S, E, I, R = current_state
+    birth_rate, death_rate, beta, alpha, gamma, N = arguments
+    next_s = S + delta_t*((birth_rate(current_t) - (death_rate(current_t) * S) - (beta(current_t) * (I/N) * S)))
+    next_e = E + delta_t*(beta(current_t) * (I/N) * S - (death_rate(current_t) + alpha(current_t)) * E)
+    next_i = I + delta_t*((alpha(current_t) * E) - ((gamma(current_t) + death_rate(current_t)) * I))
+    next_r = R + delta_t*((gamma(current_t) * I) - (death_rate(current_t) * R))
+    return next_s, next_e, next_i, next_r
+
+
+def notebook_path(start_state, parameters, start_t, last_t, delta_t):
+    """The loop of the notebook's plot_SEIR."""
+    current_state = start_state
+    state = [current_state]
+    for current_t in np.arange(start_t + delta_t, last_t, delta_t):
+        current_state = get_next_state(current_state, current_t, delta_t, parameters)
+        state.append(current_state)
+    return np.array(state)
+
+
+class EulerTest(unittest.TestCase):
+
+    def test_matches_the_notebook_across_a_change_of_beta(self):
+        N = 1000
+        notebook_parameters = (lambda t: 0, lambda t: 0, lambda t: 4 if (t < 50) else 1, lambda t: 1 / 14, lambda t: 1 / 14, N)
+        expected = notebook_path((N - 1, 1, 0, 0), notebook_parameters, 0, 100, 1)
+
+        parameters = (0, 0, seir.piecewise_constant([50], [4, 1]), 1 / 14, 1 / 14, N)
+        all_t, states = seir.integrate_seir(np.array([N - 1, 1, 0, 0]), parameters, t_end = 100, delta_t = 1, method = "euler")
+        np.testing.assert_array_equal(all_t, np.arange(0, 100))
+        np.testing.assert_allclose(states, expected, rtol = 1e-12)
+
+    def test_matches_the_notebook_for_an_ensemble(self):
+        N = 1000
+        betas, alphas = (1.7, 4), (1 / 2, 1 / 14)
+        parameters = (0, 0, seir.piecewise_constant([20], [[betas[0], betas[0]], [betas[1], 1]]), np.array(alphas), 1 / 14, N)
+        all_t, states = seir.integrate_seir(np.array([[N - 1, 1, 0, 0]] * 2), parameters, t_end = 40, delta_t = 0.5, method = "euler")
+        for i in range(2):
+            beta_after = betas[0] if i == 0 else 1
+            notebook_parameters = (lambda t: 0, lambda t: 0, lambda t, i = i: betas[i] if t < 20 else beta_after,
+                                   lambda t, i = i: alphas[i], lambda t: 1 / 14, N)
+            np.testing.assert_allclose(states[:, i], notebook_path((N - 1, 1, 0, 0), notebook_parameters, 0, 40, 0.5), rtol = 1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()